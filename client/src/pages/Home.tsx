@@ -6,7 +6,7 @@ import InventorySummary from "@/components/InventorySummary";
 import ActivityFeed from "@/components/ActivityFeed";
 import Notifications from "@/components/Notifications";
 import { useWebSocket } from "@/hooks/useWebSocket";
-import { useEffect, useState } from "react";
+import { useEffect, useRef, useState } from "react";
 import { FridgeItem, SystemStats, LogMessage, Notification, DetectedItem } from "@/types";
 import { useQuery } from "@tanstack/react-query";
 
@@ -25,6 +25,8 @@ export default function Home() {
   const [logs, setLogs] = useState<LogMessage[]>([]);
   const [notifications, setNotifications] = useState<Notification[]>([]);
   const [detectedItems, setDetectedItems] = useState<DetectedItem[]>([]);
+  // Inventory version we are up to date with, so a refresh only fetches deltas
+  const inventoryVersion = useRef<{ epoch: number | null; version: number }>({ epoch: null, version: 0 });
   
   // Fetch initial items
   const { data: initialItems } = useQuery<FridgeItem[]>({
@@ -37,10 +39,24 @@ export default function Home() {
     }
   }, [initialItems]);
 
+  const mergeItems = (prev: FridgeItem[], changed: FridgeItem[]) => {
+    const byId = new Map(prev.map(item => [item.item_id, item]));
+    changed.forEach(item => byId.set(item.item_id, item));
+    return Array.from(byId.values());
+  };
+
   const onMessage = (data: any) => {
     const parsedData = JSON.parse(data);
     
-    if (parsedData.type === 'item_added' || parsedData.type === 'item_updated') {
+    if (parsedData.type === 'refresh_complete') {
+      setItems(prev => parsedData.full ? parsedData.items : mergeItems(prev, parsedData.items));
+      if (parsedData.epoch !== undefined) {
+        inventoryVersion.current = { epoch: parsedData.epoch, version: parsedData.version };
+      }
+    } else if (parsedData.type === 'item_added' || parsedData.type === 'item_updated') {
+      if (parsedData.version !== undefined && inventoryVersion.current.epoch !== null) {
+        inventoryVersion.current.version = Math.max(inventoryVersion.current.version, parsedData.version);
+      }
       // Update items list
       setItems(prev => {
         const updatedItems = [...prev];
@@ -112,6 +128,11 @@ export default function Home() {
         timestamp: new Date()
       };
       setLogs(prev => [newLog, ...prev].slice(0, 20));
+      
+      // Catch up on whatever changed while we were disconnected
+      if (inventoryVersion.current.epoch !== null) {
+        handleRefreshInventory();
+      }
     },
     onClose: () => {
       setStats(prev => ({
@@ -127,7 +148,8 @@ export default function Home() {
   };
   
   const handleRefreshInventory = () => {
-    sendMessage(JSON.stringify({ action: 'refresh_inventory' }));
+    const { epoch, version } = inventoryVersion.current;
+    sendMessage(JSON.stringify({ action: 'refresh_inventory', since: epoch !== null ? version : undefined, epoch }));
   };
   
   // Check for expiring items and create notifications
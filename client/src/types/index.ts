@@ -1,6 +1,7 @@
 // FridgeItem model
 export interface FridgeItem {
   item_id: number;
+  source?: string;
   name: string;
   first_seen: string;
   last_seen: string;
@@ -15,6 +16,14 @@ export interface SystemStats {
   modelInfo: string;
   inferenceSpeed: string;
   processingStatus: string;
+  inferenceBatch?: string;
+  motionGate?: string;
+  tracks?: string;
+  inferenceCache?: string;
+  captureControl?: string;
+  dbFlush?: string;
+  detectionHistory?: string;
+  startup?: string;
 }
 
 // Log message
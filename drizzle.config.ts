@@ -8,6 +8,10 @@ export default defineConfig({
   out: "./db/migrations",
   schema: "./shared/schema.ts",
   dialect: "postgresql",
+  // Only manage the tables declared in schema.ts. The detection history tables
+  // (detections, its daily partitions and detection_hourly) are created by the
+  // Python server, and `db:push --force` would otherwise drop them.
+  tablesFilter: ["fridge_items", "users"],
   dbCredentials: {
     url: process.env.DATABASE_URL,
   },
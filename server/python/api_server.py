@@ -1,27 +1,225 @@
 import json
-import queue
-import time
-import threading
-import os
-# Not using asyncio and websockets in this simplified version
+import asyncio
+from collections import OrderedDict
+from http import HTTPStatus
+from urllib.parse import parse_qs
+from metrics import registry
+
+class ClientBuffer:
+    """Bounded per-client send buffer.
+    
+    Pending system_stats are coalesced into the latest one and a pending
+    update for an item is replaced by a newer one, so a slow client only
+    ever receives current state. When the buffer is still full the oldest
+    pending message is dropped.
+    """
+    
+    def __init__(self, max_size=256, types=None, sources=None):
+        self.max_size = max_size
+        self.pending = OrderedDict()
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.seq = 0
+        # Subscription filters; None means everything
+        self.types = types
+        self.sources = sources
+    
+    def wants(self, message):
+        if self.types is not None and message["type"] not in self.types:
+            return False
+        if self.sources is not None and message["source"] is not None and message["source"] not in self.sources:
+            return False
+        return True
+    
+    def push(self, message):
+        """Queue a prepared message, coalescing by its key"""
+        if not self.wants(message):
+            return
+        key = message["key"]
+        if key is None:
+            self.seq += 1
+            key = ("seq", self.seq)
+        existing = self.pending.get(key)
+        if existing is not None:
+            self.dropped += 1
+            if key == "system_stats":
+                # Latest stats go to the back of the line
+                del self.pending[key]
+            elif existing["type"] == "item_added" and message["type"] == "item_updated":
+                # Keep the client's view of the item as an addition
+                event = dict(message["event"], type="item_added")
+                message = dict(message, type="item_added", payload=json.dumps(event, ensure_ascii=False))
+        self.pending[key] = message
+        while len(self.pending) > self.max_size:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        self.ready.set()
+    
+    def take(self):
+        """Return and clear every pending payload"""
+        payloads = [message["payload"] for message in self.pending.values()]
+        self.pending.clear()
+        self.ready.clear()
+        return payloads
 
 class APIServer:
-    def __init__(self, event_queue):
+    def __init__(self, event_queue, db_writer=None, host="127.0.0.1", port=8765, client_buffer_size=256):
         self.event_queue = event_queue
+        # Source of /items snapshots
+        self.db_writer = db_writer
+        self.host = host
+        self.port = port
+        self.client_buffer_size = client_buffer_size
         self.clients = set()
+        self.loop = None
     
     def run(self, stop_flag):
-        """Run the API server in a separate thread"""
+        """Run the WebSocket/HTTP server in this thread's own event loop"""
         self.event_queue.put({"type": "log", "message": "WebSocket サーバー起動中..."})
         
-        # API server uses a simpler approach since it just forwards events
-        # Node.js handles the actual WebSocket server, we just send events to stdout
-        self.event_queue.put({"type": "log", "message": "WebSocket サーバー準備完了"})
+        try:
+            asyncio.run(self.serve(stop_flag))
+        except Exception as e:
+            self.event_queue.put({"type": "log", "message": f"APIサーバーエラー: {str(e)}"})
+    
+    async def serve(self, stop_flag):
+        """Serve /ws event streams and /items snapshots until stopped"""
+        from websockets.asyncio.server import serve
         
-        # Main loop - forward events to stdout
-        while not stop_flag.is_set():
-            try:
-                # Sleep to avoid high CPU usage
-                time.sleep(0.1)
-            except Exception as e:
-                self.event_queue.put({"type": "log", "message": f"APIサーバーエラー: {str(e)}"})
+        self.loop = asyncio.get_running_loop()
+        async with serve(self.handle_client, self.host, self.port, process_request=self.process_request):
+            self.event_queue.put({"type": "log", "message": f"WebSocket サーバー準備完了 (ポート {self.port})"})
+            self.event_queue.put({"type": "ready", "component": "api_server"})
+            while not stop_flag.is_set():
+                await asyncio.to_thread(stop_flag.wait, 1)
+        self.loop = None
+    
+    def process_request(self, connection, request):
+        """Answer plain HTTP requests (/items, /metrics); WebSocket upgrades on /ws pass through"""
+        path, _, query = request.path.partition("?")
+        if path == "/ws":
+            return None
+        if path == "/items":
+            # /items?since=<version>&epoch=<epoch> returns a delta envelope instead of the bare list;
+            # a blank since asks for the envelope with a full snapshot
+            params = {name: values[-1] for name, values in parse_qs(query, keep_blank_values=True).items()}
+            if "since" in params:
+                body = self.get_inventory(params.get("since"), params.get("epoch"))
+            else:
+                body = self.get_items()
+            response = connection.respond(HTTPStatus.OK, json.dumps(body, ensure_ascii=False) + "\n")
+            response.headers["Content-Type"] = "application/json; charset=utf-8"
+            return response
+        if path == "/metrics":
+            response = connection.respond(HTTPStatus.OK, registry.prometheus())
+            response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+            return response
+        return connection.respond(HTTPStatus.NOT_FOUND, "Not Found\n")
+    
+    async def handle_client(self, websocket):
+        """Stream buffered events to one subscriber"""
+        client = ClientBuffer(self.client_buffer_size)
+        self.clients.add(client)
+        sender = asyncio.create_task(self.send_loop(websocket, client))
+        try:
+            async for raw in websocket:
+                await self.handle_message(websocket, client, raw)
+        except Exception:
+            pass
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+    
+    async def send_loop(self, websocket, client):
+        """Send whatever is pending for a client, one wake-up per burst"""
+        while True:
+            await client.ready.wait()
+            for payload in client.take():
+                await websocket.send(payload)
+    
+    async def handle_message(self, websocket, client, raw):
+        """Handle subscribe and refresh_inventory requests from a client"""
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return
+        
+        if data.get("action") == "subscribe":
+            # Delta subscription: optional type/source filters, then a snapshot followed by changes only
+            types = data.get("types")
+            sources = data.get("sources")
+            client.types = set(types) if types else None
+            client.sources = set(sources) if sources else None
+            if data.get("snapshot", True):
+                await websocket.send(self.snapshot_payload(client.sources))
+        
+        if data.get("action") == "refresh_inventory":
+            # Clients that pass their last version and epoch only get what changed since
+            await websocket.send(self.snapshot_payload(client.sources, data.get("since"), data.get("epoch")))
+    
+    def get_items(self, sources=None):
+        """Return the current item list from the DB writer's index"""
+        if self.db_writer is None:
+            return []
+        items = self.db_writer.get_items()
+        if sources is not None:
+            items = [item for item in items if item["source"] in sources]
+        return items
+    
+    def get_inventory(self, since=None, epoch=None, sources=None):
+        """Return the items changed since a version, or a full snapshot if that can't be served"""
+        try:
+            since = int(since) if since is not None else None
+            epoch = int(epoch) if epoch is not None else None
+        except (TypeError, ValueError):
+            since = epoch = None
+        if self.db_writer is None:
+            return {"full": True, "epoch": None, "version": 0, "items": []}
+        inventory = self.db_writer.get_inventory(since, epoch)
+        if sources is not None:
+            inventory["items"] = [item for item in inventory["items"] if item["source"] in sources]
+        return inventory
+    
+    def snapshot_payload(self, sources=None, since=None, epoch=None):
+        inventory = self.get_inventory(since, epoch, sources)
+        return json.dumps(dict(inventory, type="refresh_complete"), ensure_ascii=False)
+    
+    def publish(self, events, payloads=None):
+        """Fan events out to every client; safe to call from any thread.
+        
+        payloads are the events already serialized to JSON bytes, if the
+        caller has them.
+        """
+        if self.loop is None or not self.clients or not events:
+            return
+        # Serialize once, share the payload across all clients
+        payloads = payloads or [None] * len(events)
+        messages = [self.prepare(event, payload) for event, payload in zip(events, payloads)]
+        self.loop.call_soon_threadsafe(self.deliver, messages)
+    
+    def prepare(self, event, payload=None):
+        """Serialize an event, unless already done, and work out its coalescing key"""
+        event_type = event.get("type")
+        item = event.get("item") or {}
+        if event_type == "system_stats":
+            key = "system_stats"
+        elif event_type in ("item_added", "item_updated"):
+            key = ("item", item.get("item_id"))
+        else:
+            key = None
+        return {
+            "type": event_type,
+            "source": item.get("source"),
+            "key": key,
+            "event": event,
+            "payload": payload.decode("utf-8") if payload is not None else json.dumps(event, ensure_ascii=False)
+        }
+    
+    def deliver(self, messages):
+        for client in list(self.clients):
+            for message in messages:
+                client.push(message)
+    
+    def get_dropped(self):
+        """Return how many messages were coalesced or dropped for slow clients"""
+        return sum(client.dropped for client in self.clients)
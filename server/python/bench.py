@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+"""Headless pipeline benchmark: StreamReceiver -> InferenceService -> DBWriter.
+
+Frames come from a synthetic generator or a recorded video file, and the
+database is an in-memory fake of the cursor API, so no camera or Postgres is
+needed. Results are written as JSON so runs can be diffed between commits.
+    
+    python bench.py --source synthetic --width 1280 --height 720 --fps 30 --duration 30
+    python bench.py --source recording.mp4 --output bench_results.json
+    python bench.py --micro
+"""
+import argparse
+import json
+import os
+import platform
+import queue
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import numpy as np
+from datetime import datetime
+from db_writer import DBWriter, format_timestamp
+from food_classes import FOOD_CLASSES
+from frame_ring import FrameRing
+from inference_backends import LetterboxBuffer
+from inference_service import InferenceService
+from metrics import registry, StartupTimer
+from motion_gate import MotionGate
+from capture_controller import CaptureController
+from result_cache import ResultCache
+from regions import parse_tiles
+from records import Frame, Detection, as_detections, pack_detections
+from pipeline import Pipeline, Channel
+from stream_receiver import StreamReceiver, FairFrameQueue
+
+class FakeCursor:
+    """Enough of a DictCursor for DBWriter's queries"""
+    
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+    
+    def execute(self, query, params=None):
+        self.database.wait()
+        if query.startswith("EXECUTE fridge_items_upsert"):
+            self.rows = self.database.upsert(zip(*params))
+        elif query.lstrip().upper().startswith("SELECT"):
+            self.rows = list(self.database.table.values())
+        else:
+            self.rows = []
+    
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+    
+    def fetchall(self):
+        return self.rows
+
+class FakePool:
+    """In-memory fridge_items table behind the DatabasePool interface, with a simulated round-trip latency"""
+    
+    def __init__(self, latency=0.001):
+        self.latency = latency
+        self.table = {}
+        self.next_id = 1
+        self.statements = 0
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        self.statements += 1
+        if self.latency:
+            time.sleep(self.latency)
+    
+    def connect(self):
+        pass
+    
+    def transaction(self, work, prepare=True):
+        result = work(FakeCursor(self))
+        # Commit round trip
+        self.wait()
+        return result
+    
+    def upsert(self, rows):
+        """Apply (source, name, first_seen, last_seen) rows like the ON CONFLICT upsert"""
+        results = []
+        with self.lock:
+            for source, name, first_seen, last_seen in rows:
+                # Column values come back as datetimes, like psycopg2's
+                first_seen = datetime.strptime(first_seen, "%Y-%m-%d %H:%M:%S")
+                last_seen = datetime.strptime(last_seen, "%Y-%m-%d %H:%M:%S")
+                row = self.table.get((source, name))
+                inserted = row is None
+                if inserted:
+                    row = self.table[(source, name)] = {
+                        "item_id": self.next_id, "source": source, "name": name,
+                        "first_seen": first_seen, "last_seen": last_seen
+                    }
+                    self.next_id += 1
+                else:
+                    row["last_seen"] = max(row["last_seen"], last_seen)
+                results.append(dict(row, inserted=inserted))
+        return results
+    
+    def close(self):
+        pass
+
+class FakeDBWriter(DBWriter):
+    """DBWriter running against FakePool instead of PostgreSQL"""
+    
+    def __init__(self, result_queue, event_queue, db_latency=0.001, **options):
+        super().__init__(result_queue, event_queue, **options)
+        self.pool = FakePool(db_latency)
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=5,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except Exception:
+        return None
+
+def resource_usage():
+    """CPU seconds and peak RSS for this process and its finished children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss_scale = 1 / 1024 if sys.platform != "darwin" else 1 / (1024 * 1024)
+    return {
+        "cpu_user_s": round(own.ru_utime + children.ru_utime, 3),
+        "cpu_system_s": round(own.ru_stime + children.ru_stime, 3),
+        "rss_peak_mb": round(own.ru_maxrss * rss_scale, 1),
+        "children_rss_peak_mb": round(children.ru_maxrss * rss_scale, 1)
+    }
+
+def run_pipeline(args):
+    """Run the full pipeline for args.duration seconds and return the results"""
+    uri = f"synthetic://{args.width}x{args.height}" if args.source == "synthetic" else args.source
+    sources = [{"id": f"bench{i}", "uri": uri, "fps": args.fps} for i in range(args.sources)]
+    
+    stop_flag = threading.Event()
+    event_queue = Channel(name="events")
+    pipeline = Pipeline(stop_flag, event_queue)
+    frame_queue = pipeline.add_channel("frames", FairFrameQueue(per_source_size=args.frame_queue))
+    result_queue = pipeline.channel("results", maxsize=30, policy=args.result_policy)
+    registry.add_gauges(pipeline.get_channel_stats)
+    frame_rings = {source["id"]: FrameRing(args.ring_slots, args.height, args.width) for source in sources}
+    
+    db_writer = FakeDBWriter(
+        result_queue, event_queue,
+        db_latency=args.db_latency_ms / 1000,
+        batch_size=args.db_batch_size,
+        last_seen_resolution=args.last_seen_resolution,
+        writers=args.db_writers
+    )
+    registry.add_gauges(db_writer.get_write_queue_stats)
+    controller = CaptureController(frame_queue, target_latency=args.target_latency_ms / 1000) if args.adaptive else None
+    inference_service = InferenceService(
+        frame_queue, result_queue, event_queue, frame_rings,
+        backend=args.backend,
+        num_workers=args.workers,
+        backend_options={"detection_interval": args.detection_interval} if args.backend == "demo" else {},
+        batch_size=args.batch_size,
+        batch_wait=args.batch_wait_ms / 1000,
+        motion_gate=MotionGate() if args.motion_gate else None,
+        controller=controller,
+        result_cache=ResultCache(ttl=args.cache_ttl) if args.cache else None,
+        tiles=parse_tiles(args.tiles)
+    )
+    stream_receiver = StreamReceiver(frame_queue, event_queue, frame_rings, sources, controller=controller)
+    
+    pipeline.stage("db_writer", db_writer.run, consumes=["results"])
+    pipeline.add_channel("in_flight", inference_service.in_flight)
+    pipeline.stage("inference", inference_service.run, consumes=["frames"], produces=["in_flight"])
+    pipeline.stage("inference_results", inference_service.collect, consumes=["in_flight"], produces=["results"])
+    pipeline.stage("stream_receiver", stream_receiver.run, produces=["frames"])
+    if controller is not None:
+        pipeline.stage("capture_control", controller.run)
+    
+    # Event sink - stands in for the stdout bridge and records emit latency, readiness and first detection
+    event_counts = {}
+    startup = StartupTimer(time.time(), ["db_writer", "inference"] + [f"stream_receiver:{source['id']}" for source in sources])
+    def sink(stop):
+        while not stop.is_set():
+            try:
+                event = event_queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            event_counts[event["type"]] = event_counts.get(event["type"], 0) + 1
+            if event["type"] == "ready":
+                startup.mark_ready(event["component"] + (f":{event['source']}" if event.get("source") else ""))
+            elif event["type"] in ("item_added", "item_updated"):
+                startup.mark_detection()
+            trace = event.pop("trace", None)
+            if trace:
+                now = time.time()
+                registry.observe("event_emit", now - trace.get("db_commit", trace["inference_end"]))
+                registry.observe("end_to_end", now - trace["capture"])
+    pipeline.stage("event_sink", sink)
+    
+    start_time = startup.start = time.time()
+    pipeline.start()
+    # Let the stages warm up before the measured window
+    time.sleep(args.warmup)
+    captured_before = sum(int(ring.write_seq[0]) for ring in frame_rings.values())
+    processed_before = registry.histogram("capture_to_result").count
+    measure_start = time.time()
+    time.sleep(args.duration)
+    measured = time.time() - measure_start
+    captured = sum(int(ring.write_seq[0]) for ring in frame_rings.values()) - captured_before
+    processed = registry.histogram("capture_to_result").count - processed_before
+    pipeline.stop(timeout=10)
+    for ring in frame_rings.values():
+        ring.close()
+    
+    snapshot = registry.snapshot()
+    return {
+        "captured_fps": round(captured / measured, 2),
+        "processed_fps": round(processed / measured, 2),
+        "frames": {
+            "captured": captured,
+            "processed": processed,
+            "gated": inference_service.gated_frames,
+            "cached": inference_service.cached_frames,
+            "ring_overwritten": inference_service.dropped_frames,
+            "queue_dropped": sum(frame_queue.dropped.values()),
+            "drop_rate": round(1 - processed / captured, 4) if captured else 0.0
+        },
+        "stages": snapshot["stages"],
+        "queues": snapshot["queues"],
+        "events": event_counts,
+        "startup": startup.snapshot(),
+        "capture_control": controller.get_stats() if controller is not None else None,
+        "db_statements": db_writer.pool.statements,
+        "wall_s": round(time.time() - start_time, 2),
+        "resources": resource_usage()
+    }
+
+def time_per_call(fn, iterations):
+    """Return mean microseconds per call"""
+    start = time.perf_counter()
+    for i in range(iterations):
+        fn(i)
+    return round((time.perf_counter() - start) / iterations * 1e6, 2)
+
+def run_micro(args):
+    """Microbenchmarks for process_detection and the inference loop body"""
+    results = {}
+    event_queue = queue.Queue()
+    now = time.time()
+    
+    def detection(i):
+        return Detection("bench", i % len(FOOD_CLASSES), 0.9, now + i * 0.01, 0.1, 0.1, 0.2, 0.2)
+    
+    for latency_ms in (0, args.db_latency_ms):
+        db_writer = FakeDBWriter(queue.Queue(), event_queue, db_latency=latency_ms / 1000)
+        results[f"process_detection_us@{latency_ms}ms"] = time_per_call(
+            lambda i: db_writer.process_detection(detection(i)), args.iterations
+        )
+        while not event_queue.empty():
+            event_queue.get()
+    
+    frame = np.random.RandomState(0).randint(0, 255, (args.height, args.width, 3), dtype=np.uint8)
+    buffer = LetterboxBuffer(args.batch_size, 640)
+    frames = [frame] * args.batch_size
+    results[f"letterbox_fill_us@{args.batch_size}"] = time_per_call(lambda i: buffer.fill(frames), 50)
+    
+    gate = MotionGate()
+    results["motion_gate_check_us"] = time_per_call(lambda i: gate.check("bench", frame, now + i), 200)
+    
+    # Result release: per-frame split, detection records and result queue hand-off
+    result_queue = queue.Queue()
+    service = InferenceService(queue.Queue(), result_queue, event_queue, {})
+    raw = as_detections([(name, 0.9, 0.1, 0.1, 0.2, 0.2) for name in random.sample(FOOD_CLASSES, 5)])
+    frames = [Frame("bench", 0, 0, now) for _ in range(args.batch_size)]
+    for frame in frames:
+        frame.dequeued = now
+    packed = pack_detections([raw] * len(frames))
+    def release(i):
+        service.release_result(frames, (packed, now, now + 0.01))
+        while not result_queue.empty():
+            result_queue.get()
+    results[f"release_result_us@{args.batch_size}x5"] = time_per_call(release, args.iterations // 10)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless pipeline benchmark")
+    parser.add_argument("--source", default="synthetic", help="'synthetic' or a video file path")
+    parser.add_argument("--sources", type=int, default=1, help="number of copies of the source")
+    parser.add_argument("--width", type=int, default=1280)
+    parser.add_argument("--height", type=int, default=720)
+    parser.add_argument("--fps", type=float, default=15)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--backend", default="demo")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--batch-wait-ms", type=float, default=20)
+    parser.add_argument("--detection-interval", type=float, default=0.0, help="demo backend: seconds between detections")
+    parser.add_argument("--motion-gate", action="store_true")
+    parser.add_argument("--tiles", default="1x1", help="tile grid per frame, e.g. 2x2")
+    parser.add_argument("--cache", action="store_true", help="reuse detections for near-identical frames")
+    parser.add_argument("--cache-ttl", type=float, default=5)
+    parser.add_argument("--adaptive", action="store_true", help="run the capture controller")
+    parser.add_argument("--target-latency-ms", type=float, default=500)
+    parser.add_argument("--frame-queue", type=int, default=8)
+    parser.add_argument("--ring-slots", type=int, default=16)
+    parser.add_argument("--result-policy", default="block")
+    parser.add_argument("--db-latency-ms", type=float, default=1.0)
+    parser.add_argument("--db-batch-size", type=int, default=64)
+    parser.add_argument("--db-writers", type=int, default=2)
+    parser.add_argument("--last-seen-resolution", type=float, default=30)
+    parser.add_argument("--micro", action="store_true", help="run microbenchmarks instead of the pipeline")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--output", default="bench_results.json")
+    args = parser.parse_args()
+    
+    results = {
+        "commit": git_commit(),
+        "timestamp": format_timestamp(time.time()),
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "config": vars(args)
+    }
+    if args.micro:
+        results["micro"] = run_micro(args)
+    else:
+        results["pipeline"] = run_pipeline(args)
+    
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(json.dumps(results, indent=2, ensure_ascii=False))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+import threading
+from collections import deque
+
+# Operating points from full quality to lightest load: publish every stride-th
+# captured frame and run the model at input_scale of its configured input size
+DEFAULT_LEVELS = (
+    (1, 1.0),
+    (2, 1.0),
+    (2, 0.75),
+    (3, 0.75),
+    (4, 0.5),
+    (6, 0.5),
+)
+
+def parse_levels(text):
+    """Parse CAPTURE_LEVELS, e.g. "1:1.0,2:1.0,3:0.75,4:0.5" (stride:input_scale)"""
+    levels = []
+    for entry in (part.strip() for part in text.split(",")):
+        if not entry:
+            continue
+        stride, _, scale = entry.partition(":")
+        levels.append((max(int(stride), 1), float(scale) if scale else 1.0))
+    return tuple(levels) or DEFAULT_LEVELS
+
+class CaptureController:
+    """Feedback controller that trades capture rate and input resolution for stable latency.
+    
+    Every interval it looks at the capture-to-result latency of the frames
+    inferred since the last tick and at frame queue occupancy. When either is
+    over target it steps down the ladder of operating points right away; it
+    steps back up only after ramp_up_ticks quiet ticks in a row, or after a
+    single quiet tick if the motion gate saw a change.
+    """
+    
+    def __init__(self, frame_queue, levels=DEFAULT_LEVELS, target_latency=0.5, interval=1.0,
+                 high_occupancy=0.75, low_occupancy=0.25, ramp_up_ticks=5, settle_ticks=1):
+        self.frame_queue = frame_queue
+        self.levels = tuple(levels)
+        self.target_latency = target_latency
+        self.interval = interval
+        self.high_occupancy = high_occupancy
+        self.low_occupancy = low_occupancy
+        self.ramp_up_ticks = ramp_up_ticks
+        self.level = 0
+        # Operating point read by the capture threads and the inference dispatcher
+        self.stride, self.input_scale = self.levels[0]
+        self.latencies = deque(maxlen=1024)
+        self.latency = 0.0
+        self.occupancy = 0.0
+        self.quiet_ticks = 0
+        # Frames already queued still reflect the old operating point, so wait before judging the new one
+        self.settle_ticks = settle_ticks
+        self.settling = 0
+        self.motion = threading.Event()
+        self.changes = 0
+    
+    def observe(self, latency):
+        """Record one frame's capture-to-result latency"""
+        self.latencies.append(latency)
+    
+    def note_motion(self):
+        """Tell the controller the scene changed, so it may ramp up sooner"""
+        self.motion.set()
+    
+    def run(self, stop_flag):
+        """Adjust the operating point every interval until stopped"""
+        while not stop_flag.wait(self.interval):
+            self.adjust()
+    
+    def adjust(self):
+        """Step down when overloaded, up when there has been headroom for long enough"""
+        latencies = [self.latencies.popleft() for _ in range(len(self.latencies))]
+        # Nothing inferred (e.g. every frame gated) counts as headroom
+        self.latency = sum(latencies) / len(latencies) if latencies else 0.0
+        capacity = self.frame_queue.maxsize
+        self.occupancy = self.frame_queue.qsize() / capacity if capacity else 0.0
+        motion = self.motion.is_set()
+        self.motion.clear()
+        if self.settling:
+            self.settling -= 1
+            return
+        
+        if self.latency > self.target_latency or self.occupancy > self.high_occupancy:
+            self.quiet_ticks = 0
+            self.set_level(self.level + 1)
+        elif self.latency < self.target_latency / 2 and self.occupancy < self.low_occupancy:
+            self.quiet_ticks += 1
+            if self.quiet_ticks >= self.ramp_up_ticks or motion:
+                self.quiet_ticks = 0
+                self.set_level(self.level - 1)
+        else:
+            self.quiet_ticks = 0
+    
+    def set_level(self, level):
+        level = min(max(level, 0), len(self.levels) - 1)
+        if level != self.level:
+            self.level = level
+            self.stride, self.input_scale = self.levels[level]
+            self.settling = self.settle_ticks
+            self.changes += 1
+    
+    def reset(self):
+        """Return to full quality and forget the measurements so far"""
+        self.set_level(0)
+        self.latencies.clear()
+        self.latency = 0.0
+        self.quiet_ticks = 0
+        self.settling = 0
+    
+    def get_stats(self):
+        """Return the current operating point and what it is based on"""
+        return (
+            f"レベル {self.level}/{len(self.levels) - 1}: 1/{self.stride} フレーム, 入力 {int(self.input_scale * 100)}%"
+            f" ({int(self.latency * 1000)}ms, キュー {self.occupancy * 100:.0f}%)"
+        )
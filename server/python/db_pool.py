@@ -0,0 +1,132 @@
+import io
+import csv
+import threading
+
+# Imported on first connect, on the DB writer's thread rather than at process start
+psycopg2 = None
+PreparedConnection = None
+
+def import_driver():
+    global psycopg2, PreparedConnection
+    import psycopg2
+    import psycopg2.pool
+    import psycopg2.extras
+    import psycopg2.extensions
+    import psycopg2.errors
+    
+    class PreparedConnection(psycopg2.extensions.connection):
+        """Connection that remembers whether the pool's statements are prepared on it"""
+        prepared = False
+
+class ConnectionLost(Exception):
+    """The connection broke during a transaction; the work was not committed"""
+    pass
+
+class DatabasePool:
+    """Thread-safe PostgreSQL connection pool.
+    
+    Each transaction() borrows a connection, runs the work and commits. A
+    connection that breaks is closed and dropped from the pool and the
+    failure is raised as ConnectionLost, so callers can replay the work on a
+    fresh connection. Statements passed as prepare are PREPAREd once on every
+    new connection. Connections beyond minconn are closed when returned while
+    others are idle, so minconn should cover every thread that holds one.
+    """
+    
+    def __init__(self, minconn=1, maxconn=4, prepare=(), **connect_args):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.statements = list(prepare)
+        self.connect_args = connect_args
+        self.pool = None
+        self.lock = threading.Lock()
+    
+    def connect(self):
+        """Open the pool; raises if the database is unreachable"""
+        with self.lock:
+            if self.pool is None:
+                import_driver()
+                self.pool = psycopg2.pool.ThreadedConnectionPool(
+                    self.minconn, self.maxconn, connection_factory=PreparedConnection, **self.connect_args
+                )
+    
+    def transaction(self, work, prepare=True):
+        """Run work(cursor) in one transaction and commit, returning its result"""
+        if self.pool is None:
+            raise ConnectionLost("connection pool is not open")
+        try:
+            conn = self.pool.getconn()
+        except psycopg2.Error as e:
+            raise ConnectionLost(str(e)) from e
+        
+        try:
+            try:
+                result = self.run(conn, work, prepare)
+            except psycopg2.errors.InvalidSqlStatementName:
+                # The server no longer has the statements (e.g. DISCARD ALL); prepare again and replay
+                conn.rollback()
+                conn.prepared = False
+                result = self.run(conn, work, prepare)
+        except Exception as e:
+            if conn.closed or not self.rollback(conn):
+                self.discard(conn)
+                raise ConnectionLost(str(e)) from e
+            self.pool.putconn(conn)
+            raise
+        
+        self.pool.putconn(conn)
+        return result
+    
+    def run(self, conn, work, prepare):
+        if prepare and not conn.prepared:
+            self.prepare(conn)
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+            result = work(cursor)
+        conn.commit()
+        return result
+    
+    def prepare(self, conn):
+        with conn.cursor() as cursor:
+            for statement in self.statements:
+                cursor.execute(statement)
+        conn.commit()
+        conn.prepared = True
+    
+    def rollback(self, conn):
+        """Roll back a failed transaction, returning False if the connection is unusable"""
+        try:
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def discard(self, conn):
+        """Close a broken connection and remove it from the pool"""
+        try:
+            self.pool.putconn(conn, close=True)
+        except Exception:
+            pass
+    
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+
+def is_retryable(error):
+    """True for failures where replaying the same transaction can succeed"""
+    if isinstance(error, ConnectionLost):
+        return True
+    return psycopg2 is not None and isinstance(error, psycopg2.extensions.TransactionRollbackError)
+
+def copy_rows(cursor, table, columns, rows):
+    """Bulk insert rows with COPY ... FROM STDIN, much cheaper than INSERT for append-only data"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(["\\N" if value is None else value for value in row])
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buffer
+    )
@@ -1,30 +1,83 @@
 import json
-import psycopg2
-import psycopg2.extras
 import time
 import queue
 import os
+import threading
+from collections import deque, OrderedDict
+from db_pool import DatabasePool, is_retryable
+from metrics import registry
+from pipeline import Channel, ChannelClosed
+
+# Upsert for a whole coalesced batch, prepared once per connection. Rows are
+# passed as parallel arrays so a batch is a single EXECUTE; xmax = 0 only for
+# freshly inserted rows
+PREPARE_UPSERT = """
+PREPARE fridge_items_upsert (text[], text[], text[], text[]) AS
+INSERT INTO fridge_items (source, name, first_seen, last_seen)
+SELECT source, name, first_seen::timestamp, last_seen::timestamp
+FROM unnest($1, $2, $3, $4) AS batch (source, name, first_seen, last_seen)
+ON CONFLICT (source, name) DO UPDATE
+    SET last_seen = GREATEST(fridge_items.last_seen, EXCLUDED.last_seen)
+RETURNING item_id, source, name, first_seen, last_seen, (xmax = 0) AS inserted
+"""
+EXECUTE_UPSERT = "EXECUTE fridge_items_upsert (%s, %s, %s, %s)"
+
+def format_timestamp(value):
+    """Format an epoch timestamp the way fridge_items stores it"""
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value))
+
+def to_epoch(value):
+    """Convert a TIMESTAMP column value to an epoch timestamp"""
+    return value.timestamp() if hasattr(value, "timestamp") else float(value)
 
 class DBWriter:
-    def __init__(self, result_queue, event_queue):
+    def __init__(self, result_queue, event_queue, batch_size=64, flush_interval=0.05, last_seen_resolution=30, writers=2, change_log_size=1024):
         self.result_queue = result_queue
         self.event_queue = event_queue
-        self.conn = None
-        self.cursor = None
-        self.items_count = 0
+        # Connections for the writer threads plus startup queries and the detection history
+        self.pool = DatabasePool(
+            # Keep every connection open: writers overlap, and a closed one has to be re-PREPAREd
+            minconn=writers + 2,
+            maxconn=writers + 2,
+            prepare=[PREPARE_UPSERT],
+            host=os.environ.get('PGHOST', 'localhost'),
+            user=os.environ.get('PGUSER', 'postgres'),
+            password=os.environ.get('PGPASSWORD', ''),
+            database=os.environ.get('PGDATABASE', 'postgres')
+        )
+        # Authoritative (source, name) -> item index, loaded from fridge_items at startup
+        self.items = {}
+        self.lock = threading.Lock()
+        # Only write last_seen once it has moved by this many seconds
+        self.last_seen_resolution = last_seen_resolution
+        # Batching - drain up to batch_size detections or flush_interval seconds
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batch_sizes = deque(maxlen=30)
+        self.flush_times = deque(maxlen=30)
+        # Writes are sharded by item onto the writer threads, so each item's writes stay in order
+        self.write_channels = [Channel(maxsize=4, name=f"db_writes{i}") for i in range(max(writers, 1))]
+        # Replay policy for writes that hit a lost connection
+        self.max_retry_delay = 10
+        self.shutdown_retries = 3
+        self.reconnects = 0
+        # Optional DetectionHistory that is handed every detection
+        self.history = None
+        # Inventory version, bumped on every visible item change. The epoch
+        # changes per process so clients never compare versions across restarts
+        self.version = 0
+        self.epoch = int(time.time() * 1000)
+        # Change log: (source, name) -> version of its latest change, oldest first
+        self.change_log = OrderedDict()
+        self.change_log_size = change_log_size
+        # Deltas from before this version have been evicted from the log
+        self.change_log_floor = 0
     
     def connect_to_db(self):
-        """Establish connection to PostgreSQL database"""
+        """Open the PostgreSQL connection pool"""
         try:
             # Using environment variables set by Replit's PostgreSQL database
-            self.conn = psycopg2.connect(
-                host=os.environ.get('PGHOST', 'localhost'),
-                user=os.environ.get('PGUSER', 'postgres'),
-                password=os.environ.get('PGPASSWORD', ''),
-                database=os.environ.get('PGDATABASE', 'postgres')
-            )
-            # Use DictCursor to return results as dictionaries
-            self.cursor = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            self.pool.connect()
             self.event_queue.put({"type": "log", "message": "データベース接続完了"})
             
             # Create table if not exists
@@ -37,127 +90,398 @@ class DBWriter:
     
     def create_table(self):
         """Create the fridge_items table if it doesn't exist"""
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS fridge_items (
+            item_id SERIAL PRIMARY KEY,
+            source VARCHAR(64) NOT NULL DEFAULT 'default',
+            name VARCHAR(64) NOT NULL,
+            first_seen TIMESTAMP NOT NULL,
+            last_seen TIMESTAMP NOT NULL
+        );
+        """
+        # Items are tracked per source (fridge); batched upserts rely on ON CONFLICT (source, name)
+        unique_name_query = """
+        ALTER TABLE fridge_items ADD COLUMN IF NOT EXISTS source VARCHAR(64) NOT NULL DEFAULT 'default';
+        ALTER TABLE fridge_items DROP CONSTRAINT IF EXISTS fridge_items_name_unique;
+        DO $$
+        BEGIN
+            IF NOT EXISTS (
+                SELECT 1 FROM pg_constraint WHERE conname = 'fridge_items_source_name_unique'
+            ) THEN
+                ALTER TABLE fridge_items ADD CONSTRAINT fridge_items_source_name_unique UNIQUE (source, name);
+            END IF;
+        END $$;
+        """
+        def create(cursor):
+            cursor.execute(create_table_query)
+            cursor.execute(unique_name_query)
+        
         try:
-            create_table_query = """
-            CREATE TABLE IF NOT EXISTS fridge_items (
-                item_id SERIAL PRIMARY KEY,
-                name VARCHAR(64) NOT NULL,
-                first_seen TIMESTAMP NOT NULL,
-                last_seen TIMESTAMP NOT NULL
-            );
-            """
-            self.cursor.execute(create_table_query)
-            self.conn.commit()
+            # The upsert can only be prepared once the table exists
+            self.pool.transaction(create, prepare=False)
             self.event_queue.put({"type": "log", "message": "テーブルの準備完了"})
         except Exception as e:
             self.event_queue.put({"type": "log", "message": f"テーブル作成エラー: {str(e)}"})
     
     def run(self, stop_flag):
-        """Run the DB writer in a loop"""
-        # Connect to database
-        if not self.connect_to_db():
-            return
+        """Run the DB writer: batch and coalesce here, write on the writer threads"""
+        # Connect to database and load the item index, retrying until it is up
+        delay = 1
+        while not (self.connect_to_db() and self.load_items()):
+            if stop_flag.wait(delay):
+                if self.history is not None:
+                    self.history.close()
+                return
+            delay = min(delay * 2, 30)
+        self.event_queue.put({"type": "ready", "component": "db_writer"})
+        
+        writers = []
+        for channel in self.write_channels:
+            thread = threading.Thread(target=self.write_loop, args=(channel, stop_flag))
+            thread.daemon = True
+            thread.start()
+            writers.append(thread)
         
         try:
-            # Update cache of item count
-            self.update_item_count()
-            
             # Main processing loop
             while not stop_flag.is_set():
-                try:
-                    # Get detection result from queue
-                    detection = self.result_queue.get(timeout=1)
-                    
-                    # Process the detection (upsert to database)
-                    self.process_detection(detection)
-                    
-                except queue.Empty:
-                    # No items in queue, just continue
-                    pass
-                
-                # Don't hog the CPU
-                time.sleep(0.01)
+                batch = self.collect_batch()
+                if batch:
+                    self.flush_batch(batch)
+            
+            # Write out whatever is still queued or held in memory before closing
+            batch = self.collect_batch(block=False)
+            while batch:
+                self.flush_batch(batch)
+                batch = self.collect_batch(block=False)
+            self.flush_pending()
         
         except Exception as e:
             self.event_queue.put({"type": "log", "message": f"DB処理エラー: {str(e)}"})
         
         finally:
-            # Close database connection
-            if self.conn is not None:
-                self.cursor.close()
-                self.conn.close()
-                self.event_queue.put({"type": "log", "message": "データベース接続終了"})
+            # Let the writers and the detection history finish what is queued, then close the pool
+            for channel in self.write_channels:
+                channel.close()
+            for thread in writers:
+                thread.join()
+            if self.history is not None and not self.history.close():
+                self.event_queue.put({"type": "log", "message": "検出履歴の書き込みが終わらないまま接続を終了します"})
+            self.pool.close()
+            self.event_queue.put({"type": "log", "message": "データベース接続終了"})
     
-    def process_detection(self, detection):
-        """Process a detection by upserting to the database"""
+    def load_items(self, new_epoch=False):
+        """Load the item index from fridge_items, returning False on failure.
+        
+        With new_epoch the change log is restarted in the same locked section that swaps the
+        index, so it never names keys the new index lacks.
+        """
+        def select(cursor):
+            cursor.execute("SELECT item_id, source, name, first_seen, last_seen FROM fridge_items")
+            return cursor.fetchall()
+        
         try:
-            name = detection["name"]
-            timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(detection["timestamp"]))
-            
-            # Check if item already exists
-            query = "SELECT * FROM fridge_items WHERE name = %s"
-            self.cursor.execute(query, (name,))
-            existing_item = self.cursor.fetchone()
-            
-            if existing_item:
-                # Update existing item's last_seen
-                update_query = "UPDATE fridge_items SET last_seen = %s WHERE item_id = %s"
-                self.cursor.execute(update_query, (timestamp, existing_item["item_id"]))
-                self.conn.commit()
-                
-                # Send updated item to clients
-                event_data = {
-                    "type": "item_updated",
-                    "item": {
-                        "item_id": existing_item["item_id"],
-                        "name": name,
-                        "first_seen": existing_item["first_seen"].isoformat() if hasattr(existing_item["first_seen"], "isoformat") else str(existing_item["first_seen"]),
-                        "last_seen": timestamp
-                    },
-                    "confidence": detection["confidence"],
-                    "bbox": detection["bbox"]
+            rows = self.pool.transaction(select)
+            with self.lock:
+                self.items = {}
+                for row in rows:
+                    self.index_row(row, to_epoch(row["last_seen"]))
+                if new_epoch:
+                    self.epoch = int(time.time() * 1000)
+                    self.version = 0
+                    self.change_log.clear()
+                    self.change_log_floor = 0
+            return True
+        except Exception as e:
+            self.event_queue.put({"type": "log", "message": f"アイテム一覧取得エラー: {str(e)}"})
+            return False
+    
+    def reset(self):
+        """Reload the item index from fridge_items under a new epoch, so clients take a full snapshot"""
+        # Sightings inside last_seen_resolution are only in memory; write them before the index is replaced
+        self.flush_pending(inline=True)
+        self.load_items(new_epoch=True)
+    
+    def index_row(self, row, last_seen):
+        """Record a fridge_items row in the index as written up to last_seen"""
+        key = (row["source"], row["name"])
+        entry = self.items.get(key)
+        if entry is None:
+            entry = self.items[key] = {"item_id": row["item_id"], "last_seen": last_seen}
+        entry["item_id"] = row["item_id"]
+        entry["first_seen"] = to_epoch(row["first_seen"])
+        entry["last_seen"] = max(entry["last_seen"], to_epoch(row["last_seen"]))
+        entry["written_last_seen"] = last_seen
+        return entry
+    
+    def record_change(self, key):
+        """Bump the inventory version for a changed item; call with self.lock held"""
+        self.version += 1
+        self.change_log[key] = self.version
+        self.change_log.move_to_end(key)
+        while len(self.change_log) > self.change_log_size:
+            _, version = self.change_log.popitem(last=False)
+            self.change_log_floor = version
+    
+    def collect_batch(self, block=True):
+        """Drain up to batch_size detections, waiting at most flush_interval after the first"""
+        batch = []
+        try:
+            if block:
+                batch.append(self.result_queue.get(timeout=1))
+            else:
+                batch.append(self.result_queue.get(block=False))
+        except queue.Empty:
+            return batch
+        
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if block and remaining > 0:
+                    batch.append(self.result_queue.get(timeout=remaining))
+                else:
+                    batch.append(self.result_queue.get(block=False))
+            except queue.Empty:
+                break
+        return batch
+    
+    def coalesce(self, batch):
+        """Collapse repeated detections of the same item into one row change"""
+        changes = {}
+        for detection in batch:
+            key = (detection.source, detection.name)
+            timestamp = detection.timestamp
+            change = changes.get(key)
+            if change is None:
+                changes[key] = {
+                    "source": key[0],
+                    "name": key[1],
+                    "first_seen": timestamp,
+                    "last_seen": timestamp,
+                    "detection": detection
                 }
-                self.event_queue.put(event_data)
             else:
-                # Insert new item - PostgreSQL uses RETURNING to get the new ID
-                insert_query = "INSERT INTO fridge_items (name, first_seen, last_seen) VALUES (%s, %s, %s) RETURNING item_id"
-                self.cursor.execute(insert_query, (name, timestamp, timestamp))
-                # In PostgreSQL, we fetch the returned item_id
-                returned_row = self.cursor.fetchone()
-                new_id = returned_row['item_id'] if returned_row else None
-                self.conn.commit()
-                
-                # Update item count
-                self.items_count += 1
+                change["first_seen"] = min(change["first_seen"], timestamp)
+                if timestamp >= change["last_seen"]:
+                    change["last_seen"] = timestamp
+                    change["detection"] = detection
+        return list(changes.values())
+    
+    def flush_batch(self, batch, inline=False):
+        """Apply a batch of detections, writing only new items and last_seen moves past the resolution"""
+        start_time = time.time()
+        if self.history is not None:
+            self.history.add(batch)
+        changes = self.coalesce(batch)
+        
+        writes = []
+        with self.lock:
+            for change in changes:
+                entry = self.items.get((change["source"], change["name"]))
+                if entry is None:
+                    writes.append(change)
+                    continue
                 
-                # Send new item to clients
-                event_data = {
-                    "type": "item_added",
-                    "item": {
-                        "item_id": new_id,
-                        "name": name,
-                        "first_seen": timestamp,
-                        "last_seen": timestamp
-                    },
-                    "confidence": detection["confidence"],
-                    "bbox": detection["bbox"]
-                }
-                self.event_queue.put(event_data)
+                if change["last_seen"] > entry["last_seen"]:
+                    entry["last_seen"] = change["last_seen"]
+                    self.record_change((change["source"], change["name"]))
+                if entry["last_seen"] - entry["written_last_seen"] >= self.last_seen_resolution:
+                    change["last_seen"] = entry["last_seen"]
+                    # Claimed now so batches queued behind a slow write don't repeat it
+                    entry["written_last_seen"] = entry["last_seen"]
+                    writes.append(change)
+                else:
+                    # Steady-state sighting - keep it in memory only
+                    self.emit_item_event("item_updated", entry, change)
         
-        except Exception as e:
-            self.event_queue.put({"type": "log", "message": f"データベース更新エラー: {str(e)}"})
+        self.batch_sizes.append(len(batch))
+        if writes:
+            self.submit(writes, start_time, emit=True, inline=inline)
+        else:
+            self.flush_times.append(time.time() - start_time)
+            registry.observe("db_flush", time.time() - start_time)
     
-    def update_item_count(self):
-        """Update the cached item count"""
-        try:
-            query = "SELECT COUNT(*) as count FROM fridge_items"
-            self.cursor.execute(query)
-            result = self.cursor.fetchone()
-            if result:
-                self.items_count = result["count"]
-        except Exception as e:
-            self.event_queue.put({"type": "log", "message": f"アイテム数取得エラー: {str(e)}"})
+    def flush_pending(self, inline=False):
+        """Write last_seen for every item whose sightings are only held in memory"""
+        with self.lock:
+            pending = [
+                {"source": source, "name": name, "first_seen": entry["first_seen"], "last_seen": entry["last_seen"]}
+                for (source, name), entry in self.items.items()
+                if entry["last_seen"] > entry["written_last_seen"]
+            ]
+        if pending:
+            self.submit(pending, time.time(), emit=False, inline=inline)
+    
+    def submit(self, changes, start_time, emit, inline=False):
+        """Split row changes by item across the writer threads"""
+        shards = {}
+        for change in changes:
+            index = hash((change["source"], change["name"])) % len(self.write_channels)
+            shards.setdefault(index, []).append(change)
+        
+        for index, shard in shards.items():
+            job = {"changes": shard, "start_time": start_time, "emit": emit}
+            if inline:
+                self.write_job(job)
+                continue
+            while True:
+                try:
+                    self.write_channels[index].put(job, timeout=1)
+                    break
+                except queue.Full:
+                    # The writer is replaying after a lost connection - hold the batch here
+                    continue
+    
+    def write_loop(self, channel, stop_flag):
+        """Writer thread: upsert queued batches until the channel is closed and drained"""
+        while True:
+            try:
+                job = channel.get(timeout=1)
+            except ChannelClosed:
+                break
+            except queue.Empty:
+                continue
+            self.write_job(job, stop_flag)
+    
+    def write_job(self, job, stop_flag=None):
+        """Upsert one batch in a transaction, reconnecting and replaying it until committed"""
+        changes = job["changes"]
+        rows = [
+            (change["source"], change["name"], format_timestamp(change["first_seen"]), format_timestamp(change["last_seen"]))
+            for change in changes
+        ]
+        
+        delay = 0.5
+        attempts = 0
+        while True:
+            try:
+                results = self.pool.transaction(lambda cursor: self.upsert_rows(cursor, rows))
+                break
+            except Exception as e:
+                if not is_retryable(e):
+                    self.event_queue.put({"type": "log", "message": f"データベース更新エラー: {str(e)}"})
+                    return
+                attempts += 1
+                stopping = stop_flag is None or stop_flag.is_set()
+                if stopping and attempts > self.shutdown_retries:
+                    self.event_queue.put({"type": "log", "message": f"データベース未接続のため {len(rows)} 件の更新を破棄しました"})
+                    return
+                if attempts == 1:
+                    self.reconnects += 1
+                    self.event_queue.put({"type": "log", "message": f"データベース接続断 - 再接続して再送します: {str(e)}"})
+                if stopping:
+                    time.sleep(delay)
+                else:
+                    stop_flag.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+        
+        if attempts:
+            self.event_queue.put({"type": "log", "message": f"データベース再接続完了 ({len(rows)} 件を再送)"})
+        
+        commit_time = time.time()
+        by_key = {(change["source"], change["name"]): change for change in changes}
+        with self.lock:
+            for row in results:
+                change = by_key[(row["source"], row["name"])]
+                entry = self.index_row(row, change["last_seen"])
+                self.record_change((row["source"], row["name"]))
+                if not job["emit"]:
+                    continue
+                trace = change["detection"].trace
+                if trace:
+                    trace["db_commit"] = commit_time
+                    registry.observe("db_commit", commit_time - trace["inference_end"])
+                event_type = "item_added" if row["inserted"] else "item_updated"
+                self.emit_item_event(event_type, entry, change)
+        
+        self.flush_times.append(commit_time - job["start_time"])
+        registry.observe("db_flush", commit_time - job["start_time"])
+    
+    def upsert_rows(self, cursor, rows):
+        """Run the prepared batch upsert, returning the resulting rows"""
+        cursor.execute(EXECUTE_UPSERT, [list(column) for column in zip(*rows)])
+        return cursor.fetchall()
+    
+    def emit_item_event(self, event_type, entry, change):
+        """Send an item_added/item_updated event to clients"""
+        detection = change["detection"]
+        event_data = {
+            "type": event_type,
+            "item": {
+                "item_id": entry["item_id"],
+                "source": change["source"],
+                "name": change["name"],
+                "first_seen": format_timestamp(entry["first_seen"]),
+                "last_seen": format_timestamp(change["last_seen"])
+            },
+            "confidence": detection.confidence,
+            "bbox": detection.bbox,
+            "version": self.version,
+            # Internal only - stripped when the event is emitted
+            "trace": detection.trace
+        }
+        self.event_queue.put(event_data)
+    
+    def process_detection(self, detection):
+        """Process a single detection, writing on the calling thread"""
+        self.flush_batch([detection], inline=True)
+    
+    def get_items(self):
+        """Return every indexed item, most recently seen first"""
+        items = [self.item_record(key, entry) for key, entry in list(self.items.items())]
+        items.sort(key=lambda item: item["last_seen"], reverse=True)
+        return items
+    
+    def item_record(self, key, entry):
+        """Format an index entry the way /items and refresh_complete send it"""
+        return {
+            "item_id": entry["item_id"],
+            "source": key[0],
+            "name": key[1],
+            "first_seen": format_timestamp(entry["first_seen"]),
+            "last_seen": format_timestamp(entry["last_seen"])
+        }
+    
+    def get_inventory(self, since=None, epoch=None):
+        """Return the items changed after version since, or every item if the change log can't cover it.
+        
+        The result carries the current epoch and version for the client's next request.
+        """
+        with self.lock:
+            full = (
+                since is None or epoch != self.epoch
+                or since < self.change_log_floor or since > self.version
+            )
+            if full:
+                items = self.get_items()
+            else:
+                items = []
+                for key, version in reversed(self.change_log.items()):
+                    if version <= since:
+                        break
+                    items.append(self.item_record(key, self.items[key]))
+            return {"full": full, "epoch": self.epoch, "version": self.version, "items": items}
     
     def get_item_count(self):
         """Return the current item count"""
-        return self.items_count
+        return len(self.items)
+    
+    def get_flush_stats(self):
+        """Return average batch size and flush latency"""
+        if not self.flush_times:
+            return "0件/バッチ, 0ms"
+        
+        avg_size = sum(self.batch_sizes) / len(self.batch_sizes)
+        avg_time = sum(self.flush_times) / len(self.flush_times)
+        stats = f"{avg_size:.1f}件/バッチ, {int(avg_time * 1000)}ms"
+        if self.reconnects:
+            stats += f", 再接続 {self.reconnects}回"
+        return stats
+    
+    def get_write_queue_stats(self):
+        """Return depth, capacity and drop count per writer queue"""
+        return {
+            channel.name: {"depth": channel.qsize(), "capacity": channel.maxsize, "dropped": channel.dropped}
+            for channel in self.write_channels
+        }
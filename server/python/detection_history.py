@@ -0,0 +1,221 @@
+import time
+import queue
+import threading
+from datetime import datetime, timedelta
+from db_pool import copy_rows, is_retryable
+from pipeline import Channel, ChannelClosed, DROP_OLDEST
+
+HISTORY_COLUMNS = (
+    "source", "detected_at", "name", "confidence",
+    "bbox_left", "bbox_top", "bbox_width", "bbox_height", "track_id"
+)
+
+# Append-only, partitioned by day so retention is a cheap DROP TABLE; BRIN
+# suits the naturally time-ordered inserts at a fraction of a btree's size
+CREATE_HISTORY_QUERY = """
+CREATE TABLE IF NOT EXISTS detections (
+    source VARCHAR(64) NOT NULL,
+    detected_at TIMESTAMP NOT NULL,
+    name VARCHAR(64) NOT NULL,
+    confidence SMALLINT NOT NULL,
+    bbox_left REAL,
+    bbox_top REAL,
+    bbox_width REAL,
+    bbox_height REAL,
+    track_id INTEGER
+) PARTITION BY RANGE (detected_at);
+CREATE INDEX IF NOT EXISTS detections_detected_at_brin ON detections USING BRIN (detected_at);
+CREATE TABLE IF NOT EXISTS detection_hourly (
+    source VARCHAR(64) NOT NULL,
+    name VARCHAR(64) NOT NULL,
+    hour TIMESTAMP NOT NULL,
+    detections INTEGER NOT NULL,
+    avg_confidence REAL NOT NULL,
+    max_confidence SMALLINT NOT NULL,
+    first_seen TIMESTAMP NOT NULL,
+    last_seen TIMESTAMP NOT NULL,
+    PRIMARY KEY (source, name, hour)
+);
+"""
+
+# Whole hours are recomputed, so re-running a window just overwrites it
+ROLLUP_QUERY = """
+INSERT INTO detection_hourly (source, name, hour, detections, avg_confidence, max_confidence, first_seen, last_seen)
+SELECT source, name, date_trunc('hour', detected_at), count(*), avg(confidence), max(confidence),
+       min(detected_at), max(detected_at)
+FROM detections
+WHERE detected_at >= %s
+GROUP BY 1, 2, 3
+ON CONFLICT (source, name, hour) DO UPDATE
+    SET detections = EXCLUDED.detections,
+        avg_confidence = EXCLUDED.avg_confidence,
+        max_confidence = EXCLUDED.max_confidence,
+        first_seen = EXCLUDED.first_seen,
+        last_seen = EXCLUDED.last_seen
+"""
+
+PARTITIONS_QUERY = """
+SELECT child.relname FROM pg_inherits
+JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE parent.relname = 'detections'
+"""
+
+def partition_name(day):
+    return f"detections_{day:%Y%m%d}"
+
+class DetectionHistory:
+    """Append-only detection log in daily partitions, with hourly rollups.
+    
+    DBWriter hands over every detection with add(). They are buffered and
+    written with COPY in batches; a failed batch is replayed after reconnect.
+    Between batches the stage refreshes detection_hourly, creates the next
+    day's partition ahead of time and drops partitions past retention.
+    """
+    
+    def __init__(self, pool, event_queue, batch_size=500, flush_interval=1.0, retention_days=30, rollup_interval=300, buffer_size=20000):
+        self.pool = pool
+        self.event_queue = event_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.rollup_interval = rollup_interval
+        # Under sustained DB trouble the oldest history is dropped before live updates stall
+        self.buffer = Channel(buffer_size, DROP_OLDEST, name="history")
+        # Known partition names; None after a failed transaction so they are re-read
+        self.partitions = None
+        self.rollup_from = None
+        self.next_rollup_from = None
+        self.written = 0
+        self.max_retry_delay = 10
+        # Set when run() has written what it could and exited, so the shared pool can be closed
+        self.finished = threading.Event()
+    
+    def add(self, detections):
+        """Buffer detections for the next COPY"""
+        for detection in detections:
+            bbox = detection.bbox
+            self.buffer.put((
+                detection.source,
+                datetime.fromtimestamp(detection.timestamp),
+                detection.name,
+                detection.confidence,
+                bbox["left"],
+                bbox["top"],
+                bbox["width"],
+                bbox["height"],
+                detection.track_id
+            ))
+    
+    def close(self, timeout=5):
+        """No more detections; wait up to timeout for run() to write what is buffered and exit"""
+        self.buffer.close()
+        return self.finished.wait(timeout)
+    
+    def run(self, stop_flag):
+        """Write buffered detections and run maintenance until closed"""
+        try:
+            self.write_until_closed(stop_flag)
+        finally:
+            self.finished.set()
+    
+    def write_until_closed(self, stop_flag):
+        delay = 1
+        while not self.retry(self.create_tables, stop_flag):
+            if stop_flag.wait(delay):
+                return
+            delay = min(delay * 2, 30)
+        self.event_queue.put({"type": "ready", "component": "detection_history"})
+        
+        next_maintenance = 0
+        closed = False
+        while not closed:
+            if time.time() >= next_maintenance and not stop_flag.is_set():
+                if self.retry(self.maintain, stop_flag):
+                    self.rollup_from = self.next_rollup_from
+                next_maintenance = time.time() + self.rollup_interval
+            
+            rows, closed = self.collect()
+            if rows and self.retry(lambda cursor: self.append(cursor, rows), stop_flag, rows=len(rows)):
+                self.written += len(rows)
+    
+    def collect(self):
+        """Take up to batch_size rows, waiting at most flush_interval; also report whether closed"""
+        rows = []
+        deadline = time.time() + self.flush_interval
+        while len(rows) < self.batch_size:
+            try:
+                rows.append(self.buffer.get(timeout=max(deadline - time.time(), 0)))
+            except ChannelClosed:
+                return rows, True
+            except queue.Empty:
+                break
+        return rows, False
+    
+    def retry(self, work, stop_flag, rows=0):
+        """Run work(cursor) in a transaction, replaying it across reconnects until stopped"""
+        delay = 0.5
+        while True:
+            try:
+                self.pool.transaction(work, prepare=False)
+                return True
+            except Exception as e:
+                self.partitions = None
+                if not is_retryable(e) or stop_flag.is_set():
+                    message = f"検出履歴の書き込みエラー: {str(e)}"
+                    if rows:
+                        message += f" ({rows} 件を破棄)"
+                    self.event_queue.put({"type": "log", "message": message})
+                    return False
+                stop_flag.wait(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+    
+    def create_tables(self, cursor):
+        cursor.execute(CREATE_HISTORY_QUERY)
+        self.load_partitions(cursor)
+    
+    def load_partitions(self, cursor):
+        if self.partitions is None:
+            cursor.execute(PARTITIONS_QUERY)
+            self.partitions = {row[0] for row in cursor.fetchall()}
+    
+    def ensure_partition(self, cursor, day):
+        """Create the daily partition holding day if it doesn't exist"""
+        self.load_partitions(cursor)
+        name = partition_name(day)
+        if name in self.partitions:
+            return
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF detections FOR VALUES FROM (%s) TO (%s)",
+            (day.isoformat(), (day + timedelta(days=1)).isoformat())
+        )
+        self.partitions.add(name)
+    
+    def append(self, cursor, rows):
+        """COPY a batch of rows, creating the partitions it needs first"""
+        for day in {row[1].date() for row in rows}:
+            self.ensure_partition(cursor, day)
+        copy_rows(cursor, "detections", HISTORY_COLUMNS, rows)
+    
+    def maintain(self, cursor):
+        """Refresh hourly rollups, pre-create tomorrow's partition and apply retention"""
+        today = datetime.now().date()
+        self.ensure_partition(cursor, today)
+        self.ensure_partition(cursor, today + timedelta(days=1))
+        
+        # Recompute from the last completed hour onwards; the first run covers retention
+        now = datetime.now().replace(minute=0, second=0, microsecond=0)
+        since = self.rollup_from or now - timedelta(days=self.retention_days)
+        cursor.execute(ROLLUP_QUERY, (since,))
+        self.next_rollup_from = now - timedelta(hours=1)
+        
+        cutoff = partition_name(today - timedelta(days=self.retention_days))
+        for name in sorted(self.partitions):
+            if name < cutoff:
+                cursor.execute(f"DROP TABLE IF EXISTS {name}")
+                self.partitions.discard(name)
+                self.event_queue.put({"type": "log", "message": f"古い検出履歴を削除しました ({name})"})
+    
+    def get_stats(self):
+        """Return rows written, buffered and dropped"""
+        return f"{self.written}件記録, 待機{self.buffer.qsize()}件, 破棄{self.buffer.dropped}件"
@@ -0,0 +1,47 @@
+import json
+import sys
+
+class EventChannel:
+    """Newline-delimited JSON event stream to the Node.js server.
+    
+    Events are written in batches, one JSON object per line, with a single
+    write and flush per batch. orjson is used when requested and installed.
+    """
+    
+    def __init__(self, stream=None, serializer="json"):
+        self.stream = stream if stream is not None else sys.stdout.buffer
+        self.serializer = serializer
+        self.dumps = self.json_dumps
+        if serializer == "orjson":
+            try:
+                import orjson
+                self.dumps = orjson.dumps
+            except ImportError:
+                self.serializer = "json"
+        self.sent_events = 0
+        self.sent_batches = 0
+    
+    @staticmethod
+    def json_dumps(event):
+        return json.dumps(event, ensure_ascii=False).encode("utf-8")
+    
+    def send(self, event):
+        """Send a single event"""
+        self.send_batch([event])
+    
+    def serialize(self, events):
+        """Serialize events to JSON bytes, once for every consumer"""
+        return [self.dumps(event) for event in events]
+    
+    def send_batch(self, events):
+        """Send events as one framed write"""
+        self.send_payloads(self.serialize(events))
+    
+    def send_payloads(self, payloads):
+        """Send already serialized events as one framed write"""
+        if not payloads:
+            return
+        self.stream.write(b"\n".join(payloads) + b"\n")
+        self.stream.flush()
+        self.sent_events += len(payloads)
+        self.sent_batches += 1
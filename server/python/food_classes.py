@@ -0,0 +1,24 @@
+# Food class labels
+FOOD_CLASSES = [
+    "apple", "banana", "orange", "carrot", "broccoli", "tomato", "egg",
+    "cabbage", "milk", "bread", "cheese", "beef", "chicken", "fish", "rice"
+]
+
+# Japanese translations for food items
+FOOD_TRANSLATIONS = {
+    "apple": "りんご",
+    "banana": "バナナ",
+    "orange": "オレンジ",
+    "carrot": "にんじん",
+    "broccoli": "ブロッコリー",
+    "tomato": "トマト",
+    "egg": "卵",
+    "cabbage": "キャベツ",
+    "milk": "牛乳",
+    "bread": "パン",
+    "cheese": "チーズ",
+    "beef": "牛肉",
+    "chicken": "鶏肉",
+    "fish": "魚",
+    "rice": "米"
+}
@@ -0,0 +1,80 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+class FrameRing:
+    """Fixed ring of preallocated BGR frame slots in shared memory.
+    
+    The writer fills slots in place and publishes them with a sequence number;
+    readers get zero-copy views by (slot, seq). When readers fall behind the
+    writer simply overwrites the oldest slot, and stale references are detected
+    by a sequence mismatch.
+    """
+    
+    def __init__(self, num_slots, height, width, name=None, create=True):
+        self.num_slots = num_slots
+        self.height = height
+        self.width = width
+        frame_bytes = height * width * 3
+        # Header: per-slot sequence numbers and timestamps, then the write sequence
+        header_bytes = num_slots * 8 * 2 + 8
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=header_bytes + num_slots * frame_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = create
+        
+        buf = self.shm.buf
+        self.seqs = np.ndarray((num_slots,), dtype=np.int64, buffer=buf, offset=0)
+        self.timestamps = np.ndarray((num_slots,), dtype=np.float64, buffer=buf, offset=num_slots * 8)
+        self.write_seq = np.ndarray((1,), dtype=np.int64, buffer=buf, offset=num_slots * 16)
+        self.frames = np.ndarray((num_slots, height, width, 3), dtype=np.uint8, buffer=buf, offset=header_bytes)
+        if create:
+            self.seqs[:] = -1
+            self.write_seq[0] = 0
+        # Slot currently being written by this process
+        self.pending = None
+    
+    @classmethod
+    def attach(cls, spec):
+        """Attach to an existing ring from its spec()"""
+        return cls(spec["num_slots"], spec["height"], spec["width"], name=spec["name"], create=False)
+    
+    def spec(self):
+        """Return what another process needs to attach to this ring"""
+        return {"name": self.shm.name, "num_slots": self.num_slots, "height": self.height, "width": self.width}
+    
+    def acquire(self):
+        """Return the next slot to write into; it is invalid until commit()"""
+        seq = int(self.write_seq[0]) + 1
+        slot = seq % self.num_slots
+        # Readers holding the old frame in this slot will see it as stale
+        self.seqs[slot] = -1
+        self.pending = (slot, seq)
+        return self.frames[slot]
+    
+    def commit(self, timestamp):
+        """Publish the slot from acquire(), returning its (slot, seq) reference"""
+        slot, seq = self.pending
+        self.timestamps[slot] = timestamp
+        self.seqs[slot] = seq
+        self.write_seq[0] = seq
+        self.pending = None
+        return slot, seq
+    
+    def is_current(self, ref):
+        """Check that a referenced frame has not been overwritten"""
+        slot, seq = ref
+        return self.seqs[slot] == seq
+    
+    def view(self, ref):
+        """Return a zero-copy BGR view of a frame, or None if it was overwritten"""
+        if not self.is_current(ref):
+            return None
+        return self.frames[ref[0]]
+    
+    def close(self):
+        """Detach from the ring, removing it if this process created it"""
+        self.seqs = self.timestamps = self.write_seq = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
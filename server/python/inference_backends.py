@@ -0,0 +1,399 @@
+import os
+import ast
+import time
+import random
+import numpy as np
+import cv2
+from food_classes import FOOD_CLASSES
+from frame_ring import FrameRing
+from records import CLASS_IDS, as_detections, detections_from_columns, empty_detections, pack_detections
+from regions import to_frame, merge_detections
+
+# Backends take BGR frames (as captured) and return raw detections as a
+# records.DETECTION_DTYPE array, or as (class_name, confidence, left, top,
+# width, height) tuples, with confidence in 0-1 and the box as fractions of
+# the frame size.
+
+# Padding value used by YOLO letterboxing
+LETTERBOX_FILL = 114
+
+class LetterboxBuffer:
+    """Preallocated (B, 3, S, S) float32 input tensor filled by letterboxing frames"""
+    
+    def __init__(self, max_batch, input_size):
+        self.input_size = input_size
+        self.tensor = np.empty((max_batch, 3, input_size, input_size), dtype=np.float32)
+        self.canvas = np.full((input_size, input_size, 3), LETTERBOX_FILL, dtype=np.uint8)
+        # Resize targets keyed by (height, width); a camera only ever needs one
+        self.resized = {}
+    
+    def fill(self, frames):
+        """Letterbox frames into the tensor, returning the batch view and per-frame (scale, pad_x, pad_y)"""
+        size = self.input_size
+        transforms = []
+        for i, frame in enumerate(frames):
+            h, w = frame.shape[:2]
+            scale = min(size / w, size / h)
+            new_w, new_h = int(round(w * scale)), int(round(h * scale))
+            pad_x, pad_y = (size - new_w) // 2, (size - new_h) // 2
+            
+            resized = self.resized.get((new_h, new_w))
+            if resized is None:
+                resized = self.resized[(new_h, new_w)] = np.empty((new_h, new_w, 3), dtype=np.uint8)
+            cv2.resize(frame, (new_w, new_h), dst=resized, interpolation=cv2.INTER_LINEAR)
+            
+            self.canvas[:] = LETTERBOX_FILL
+            self.canvas[pad_y:pad_y + new_h, pad_x:pad_x + new_w] = resized
+            # BGR -> RGB happens here, in the same pass as the CHW transpose
+            np.multiply(self.canvas[:, :, ::-1].transpose(2, 0, 1), 1 / 255.0, out=self.tensor[i], casting="unsafe")
+            transforms.append((scale, pad_x, pad_y, w, h))
+        return self.tensor[:len(frames)], transforms
+    
+    def to_frame(self, transform, left, top, width, height):
+        """Map a box in input pixels back to fractions of the original frame"""
+        scale, pad_x, pad_y, w, h = transform
+        return (
+            (left - pad_x) / scale / w,
+            (top - pad_y) / scale / h,
+            width / scale / w,
+            height / scale / h
+        )
+
+class DetectionBackend:
+    """Base class for detection backends"""
+    name = "base"
+    
+    def __init__(self, model_path=None, confidence_threshold=0.5, max_batch=1, **options):
+        self.model_path = model_path
+        self.confidence_threshold = confidence_threshold
+        self.max_batch = max_batch
+        self.options = options
+        self.input_scale = 1.0
+    
+    def load(self):
+        """Load model weights"""
+        pass
+    
+    def set_input_scale(self, scale):
+        """Scale the model input size between batches; fixed-size models ignore it"""
+        self.input_scale = scale
+    
+    def warm_up(self, height, width):
+        """Run one full dummy batch so lazy allocation and kernel selection happen before the first real frame"""
+        frames = [np.zeros((height, width, 3), dtype=np.uint8)] * max(self.max_batch, 1)
+        self.detect_batch(frames)
+    
+    def detect(self, frame):
+        """Run detection on a single BGR frame"""
+        raise NotImplementedError
+    
+    def detect_batch(self, frames):
+        """Run detection on a list of frames, returning one detection list per frame"""
+        return [self.detect(frame) for frame in frames]
+    
+    def describe(self):
+        """Return a short model description"""
+        return self.name
+
+class DemoBackend(DetectionBackend):
+    """Emits a random food item at intervals - no model weights needed"""
+    name = "demo"
+    
+    def __init__(self, detection_interval=5, **options):
+        super().__init__(**options)
+        self.detection_interval = detection_interval  # seconds between detections
+        self.last_detection_time = time.time()
+    
+    def detect(self, frame):
+        current_time = time.time()
+        if current_time - self.last_detection_time <= self.detection_interval:
+            return []
+        self.last_detection_time = current_time
+        
+        # Pick random food item
+        class_name = random.choice(FOOD_CLASSES)
+        
+        # Random bounding box
+        width = random.uniform(0.25, 0.4)
+        height = random.uniform(0.25, 0.4)
+        left = random.uniform(0.1, 0.6)
+        top = random.uniform(0.1, 0.6)
+        
+        # Random confidence (70-95%)
+        confidence = random.uniform(0.7, 0.95)
+        return [(class_name, confidence, left, top, width, height)]
+    
+    def warm_up(self, height, width):
+        # Nothing to warm, and a dummy call would consume the detection timer
+        pass
+    
+    def describe(self):
+        return "OpenCV (デモモード)"
+
+class UltralyticsBackend(DetectionBackend):
+    """YOLO model through the ultralytics package"""
+    name = "ultralytics"
+    
+    def __init__(self, model_path="yolov8n.pt", input_size=640, **options):
+        super().__init__(model_path=model_path, **options)
+        self.input_size = input_size
+        self.base_input_size = input_size
+        self.model = None
+        # Model class id -> FOOD_CLASSES id, -1 for classes we don't track
+        self.class_lookup = None
+        self.tracked_classes = []
+        self.buffer = None
+    
+    def load(self):
+        # Heavy import, only needed when this backend is selected
+        from ultralytics import YOLO
+        self.model = YOLO(self.model_path)
+        self.buffer = LetterboxBuffer(self.max_batch, self.input_size)
+        # Only keep model classes that are food items we track
+        self.class_lookup = np.full(max(self.model.names) + 1, -1, dtype=np.int32)
+        for class_id, class_name in self.model.names.items():
+            self.class_lookup[class_id] = CLASS_IDS.get(class_name, -1)
+        self.tracked_classes = np.flatnonzero(self.class_lookup >= 0).tolist()
+    
+    def set_input_scale(self, scale):
+        # YOLO input sizes must be multiples of the 32 pixel stride
+        super().set_input_scale(scale)
+        input_size = max(int(self.base_input_size * scale) // 32 * 32, 32)
+        if input_size != self.input_size:
+            self.input_size = input_size
+            self.buffer = LetterboxBuffer(self.max_batch, input_size)
+    
+    def to_detections(self, boxes, xywh):
+        """Turn a result's center-format boxes into a detection array with FOOD_CLASSES ids"""
+        class_ids = self.class_lookup[boxes.cls.cpu().numpy().astype(int)]
+        # predict() already filters to tracked classes; this keeps untracked ids out regardless
+        keep = class_ids >= 0
+        xywh = xywh[keep]
+        return detections_from_columns(
+            class_ids[keep], boxes.conf.cpu().numpy()[keep],
+            xywh[:, 0] - xywh[:, 2] / 2, xywh[:, 1] - xywh[:, 3] / 2, xywh[:, 2], xywh[:, 3]
+        )
+    
+    def detect(self, frame):
+        results = self.model.predict(
+            frame,
+            imgsz=self.input_size,
+            conf=self.confidence_threshold,
+            classes=self.tracked_classes,
+            device="cpu",
+            verbose=False
+        )
+        return np.concatenate(
+            [empty_detections()] + [self.to_detections(result.boxes, result.boxes.xywhn.cpu().numpy()) for result in results]
+        )
+    
+    def detect_batch(self, frames):
+        import torch
+        tensor, transforms = self.buffer.fill(frames)
+        # One forward pass over the preallocated batch (shares memory with the buffer)
+        results = self.model.predict(
+            torch.from_numpy(tensor),
+            conf=self.confidence_threshold,
+            classes=self.tracked_classes,
+            device="cpu",
+            verbose=False
+        )
+        batch_detections = []
+        for result, transform in zip(results, transforms):
+            detections = self.to_detections(result.boxes, result.boxes.xywh.cpu().numpy())
+            detections["x"], detections["y"], detections["w"], detections["h"] = self.buffer.to_frame(
+                transform, detections["x"], detections["y"], detections["w"], detections["h"]
+            )
+            batch_detections.append(detections)
+        return batch_detections
+    
+    def describe(self):
+        return f"{self.model_path} (ultralytics CPU)"
+
+class OnnxBackend(DetectionBackend):
+    """YOLOv8-style ONNX export run through OpenCV DNN"""
+    name = "onnx"
+    
+    def __init__(self, model_path="yolov8n.onnx", input_size=640, labels=None, nms_threshold=0.45, **options):
+        super().__init__(model_path=model_path, **options)
+        self.input_size = input_size
+        # Model output columns follow this label order; labels we don't track map to -1 and are dropped
+        self.labels = labels or read_onnx_labels(model_path)
+        self.food_ids = np.array([CLASS_IDS.get(label, -1) for label in self.labels], dtype=np.int32)
+        self.nms_threshold = nms_threshold
+        self.net = None
+        self.buffer = None
+    
+    def load(self):
+        self.net = cv2.dnn.readNetFromONNX(self.model_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        if self.max_batch > 1 and not self.accepts_batch(self.max_batch):
+            # Static batch 1 export (the ultralytics default) - frames are run one per forward pass
+            self.max_batch = 1
+        self.buffer = LetterboxBuffer(self.max_batch, self.input_size)
+    
+    def accepts_batch(self, batch):
+        """Try one forward pass of batch frames, which only dynamic-batch exports accept"""
+        try:
+            self.net.setInput(np.zeros((batch, 3, self.input_size, self.input_size), dtype=np.float32))
+            return self.net.forward().shape[0] == batch
+        except cv2.error:
+            return False
+    
+    def detect(self, frame):
+        blob = cv2.dnn.blobFromImage(
+            frame, 1 / 255.0, (self.input_size, self.input_size), swapRB=True, crop=False
+        )
+        self.net.setInput(blob)
+        output = self.net.forward()
+        return self.parse_output(output[0])
+    
+    def detect_batch(self, frames):
+        """Batched forward pass; load() drops max_batch to 1 unless the export has a dynamic batch axis"""
+        tensor, transforms = self.buffer.fill(frames)
+        self.net.setInput(tensor)
+        output = self.net.forward()
+        batch_detections = []
+        for i, transform in enumerate(transforms):
+            detections = self.parse_output(output[i], normalized=False)
+            detections["x"], detections["y"], detections["w"], detections["h"] = self.buffer.to_frame(
+                transform, detections["x"], detections["y"], detections["w"], detections["h"]
+            )
+            batch_detections.append(detections)
+        return batch_detections
+    
+    def parse_output(self, output, normalized=True):
+        """Decode a (4 + classes, anchors) YOLOv8 output into a detection array"""
+        predictions = output.T
+        scores = predictions[:, 4:]
+        class_ids = np.argmax(scores, axis=1)
+        confidences = scores[np.arange(len(class_ids)), class_ids]
+        keep = confidences >= self.confidence_threshold
+        if not np.any(keep):
+            return empty_detections()
+        
+        boxes = predictions[keep, :4]
+        if normalized:
+            boxes = boxes / self.input_size
+        class_ids = class_ids[keep]
+        confidences = confidences[keep]
+        # Center format to left/top format
+        boxes[:, 0] -= boxes[:, 2] / 2
+        boxes[:, 1] -= boxes[:, 3] / 2
+        
+        indices = cv2.dnn.NMSBoxes(
+            boxes.tolist(), confidences.tolist(), self.confidence_threshold, self.nms_threshold
+        )
+        indices = np.array(indices, dtype=np.int64).flatten()
+        # Model label index -> FOOD_CLASSES id, dropping labels we don't track
+        class_ids = class_ids[indices]
+        food_ids = np.where(
+            class_ids < len(self.food_ids), self.food_ids[np.minimum(class_ids, len(self.food_ids) - 1)], -1
+        )
+        indices, food_ids = indices[food_ids >= 0], food_ids[food_ids >= 0]
+        return detections_from_columns(food_ids, confidences[indices], *boxes[indices].T)
+    
+    def describe(self):
+        return f"{self.model_path} (OpenCV DNN CPU)"
+
+def read_onnx_labels(model_path):
+    """Class names in output column order from an ultralytics ONNX export's metadata"""
+    try:
+        import onnx
+    except ImportError:
+        raise ValueError("Set INFERENCE_LABELS or install onnx to read the model's class names")
+    model = onnx.load(model_path, load_external_data=False)
+    metadata = {prop.key: prop.value for prop in model.metadata_props}
+    if "names" not in metadata:
+        raise ValueError(f"No class names in {model_path}; set INFERENCE_LABELS")
+    # Exported as the repr of {index: name}
+    names = ast.literal_eval(metadata["names"])
+    return [names[i] for i in range(len(names))]
+
+BACKENDS = {
+    DemoBackend.name: DemoBackend,
+    UltralyticsBackend.name: UltralyticsBackend,
+    OnnxBackend.name: OnnxBackend,
+}
+
+def create_backend(name, **options):
+    """Create a detection backend by name"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend: {name}")
+    return BACKENDS[name](**options)
+
+# Per-worker backend instance and per-source frame rings, created once by the pool initializer
+_worker_backend = None
+_worker_rings = {}
+
+def init_worker(name, options, ring_specs):
+    """Load the backend, warm it up and attach to the frame rings once in each worker"""
+    global _worker_backend, _worker_rings
+    _worker_backend = create_backend(name, **options)
+    _worker_backend.load()
+    _worker_rings = {source: FrameRing.attach(spec) for source, spec in ring_specs.items()}
+    if ring_specs:
+        spec = next(iter(ring_specs.values()))
+        _worker_backend.warm_up(spec["height"], spec["width"])
+
+def ping_worker():
+    """No-op task; once it returns the worker has loaded and warmed its model"""
+    return os.getpid()
+
+def detect_in_worker(refs, input_scale=1.0):
+    """Run batched detection on (source, slot, seq[, rects]) ring frames and return (per-frame detections, start, end).
+    
+    Detections come back packed by records.pack_detections: one
+    DETECTION_DTYPE array for the batch, which pickles as a single buffer
+    instead of a tuple per detection.
+    
+    With rects, only those (x, y, w, h) crops of the frame are run, all of them
+    in the same batched model calls, and their detections are mapped back to
+    the frame and merged across overlapping crops.
+    Frames overwritten before or during inference come back as None.
+    input_scale is the capture controller's current model input scale.
+    """
+    start_time = time.time()
+    if input_scale != _worker_backend.input_scale:
+        _worker_backend.set_input_scale(input_scale)
+    
+    # Every crop of every live frame, with the frame and rect it came from
+    crops = []
+    owners = []
+    results = {}
+    for i, ref in enumerate(refs):
+        frame = _worker_rings[ref[0]].view(ref[1:3])
+        if frame is None:
+            continue
+        results[i] = []
+        rects = ref[3] if len(ref) > 3 else None
+        if rects is None:
+            crops.append(frame)
+            owners.append((i, None))
+            continue
+        for x, y, w, h in rects:
+            crops.append(frame[y:y + h, x:x + w])
+            owners.append((i, (x, y, w, h)))
+    
+    # Tiles can outnumber the batch the model input was sized for
+    step = max(_worker_backend.max_batch, 1)
+    raw = []
+    for offset in range(0, len(crops), step):
+        raw.extend(_worker_backend.detect_batch(crops[offset:offset + step]))
+    
+    for (i, rect), detections in zip(owners, raw):
+        detections = as_detections(detections)
+        if rect is not None:
+            frame_ring = _worker_rings[refs[i][0]]
+            detections = to_frame(detections, rect, frame_ring.width, frame_ring.height)
+        results[i].append(detections)
+    detections = []
+    for i, ref in enumerate(refs):
+        if i not in results or not _worker_rings[ref[0]].is_current(ref[1:3]):
+            detections.append(None)
+        elif len(ref) > 3:
+            detections.append(merge_detections(np.concatenate(results[i])))
+        else:
+            detections.append(np.concatenate(results[i]))
+    return pack_detections(detections), start_time, time.time()
@@ -1,148 +1,368 @@
 import time
 import queue
+import threading
 import json
-import numpy as np
 import os
-import cv2
-import random
-
-# Food class labels
-FOOD_CLASSES = [
-    "apple", "banana", "orange", "carrot", "broccoli", "tomato", "egg",
-    "cabbage", "milk", "bread", "cheese", "beef", "chicken", "fish", "rice"
-]
-
-# Japanese translations for food items
-FOOD_TRANSLATIONS = {
-    "apple": "りんご",
-    "banana": "バナナ",
-    "orange": "オレンジ",
-    "carrot": "にんじん",
-    "broccoli": "ブロッコリー",
-    "tomato": "トマト",
-    "egg": "卵",
-    "cabbage": "キャベツ",
-    "milk": "牛乳",
-    "bread": "パン",
-    "cheese": "チーズ",
-    "beef": "牛肉",
-    "chicken": "鶏肉",
-    "fish": "魚",
-    "rice": "米"
-}
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, CancelledError, Future, wait
+from inference_backends import create_backend, init_worker, detect_in_worker, ping_worker
+from result_cache import dhash
+from regions import region_to_pixels, tile_rects, rects_to_percent
+from records import Detection, pack_detections, unpack_detections
+from pipeline import Channel
+from metrics import registry
 
 class InferenceService:
-    def __init__(self, frame_queue, result_queue, event_queue):
+    def __init__(self, frame_queue, result_queue, event_queue, frame_rings, backend="demo", num_workers=2,
+                 backend_options=None, batch_size=4, batch_wait=0.02, motion_gate=None, tracker=None, controller=None,
+                 result_cache=None, regions=None, tiles=(1, 1), tile_overlap=0.2):
         self.frame_queue = frame_queue
+        # Workers read frames from each source's shared memory; frame_queue only carries slot references
+        self.frame_rings = frame_rings
+        self.dropped_frames = 0
+        # Optional change gate - unchanged frames skip inference entirely
+        self.motion_gate = motion_gate
+        self.gated_frames = 0
+        # Optional tracker - only confirmed or changed tracks reach result_queue
+        self.tracker = tracker
+        # Optional per-source regions of interest and tiling; only regions that changed are re-run
+        self.regions = regions or {}
+        self.tiles = tuple(tiles)
+        self.tile_overlap = tile_overlap
+        self.region_plans = {}
+        # Optional ResultCache - near-identical frames reuse earlier detections instead of a model call
+        self.result_cache = result_cache
+        self.cached_frames = 0
+        # Optional CaptureController - fed latency and motion, sets the model input scale
+        self.controller = controller
         self.result_queue = result_queue
         self.event_queue = event_queue
         self.device = "cpu"
         self.model_info = "OpenCV (CPU)"
-        self.inference_times = []
+        self.inference_times = deque(maxlen=30)
         self.last_inference_time = 0
         self.processed_frames = 0
         self.start_time = time.time()
         self.fps = 0
-        # Demo mode - simulate detection
-        self.last_detection_time = time.time()
-        self.detection_interval = 5  # seconds between detections
+        # Detection backend - runs in num_workers processes (0 = in a thread)
+        self.backend = backend
+        self.num_workers = num_workers
+        self.backend_options = dict(backend_options or {})
+        # Micro-batching - up to batch_size frames or batch_wait seconds per model call
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.backend_options["max_batch"] = batch_size
+        self.batch_sizes = deque(maxlen=30)
+        self.batch_latencies = deque(maxlen=30)
+        if backend == "demo":
+            # Each worker keeps its own timer, so spread the demo interval across them
+            self.backend_options.setdefault("detection_interval", 5 * max(num_workers, 1))
+        self.executor = None
+        # Batches dispatched to workers, in capture order; dispatch blocks when it is full
+        self.max_in_flight = max(num_workers, 1) * 2
+        self.in_flight = Channel(self.max_in_flight, name="in_flight")
+        # Set by reset() after the model or worker pool failed, to start them again
+        self.failed = False
+        self.restarting = threading.Event()
+    
+    def start_workers(self):
+        """Start the worker pool; each worker loads the backend once"""
+        if self.num_workers > 0:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.num_workers,
+                initializer=init_worker,
+                initargs=(self.backend, self.backend_options, self.ring_specs())
+            )
+        else:
+            self.executor = ThreadPoolExecutor(
+                max_workers=1,
+                initializer=init_worker,
+                initargs=(self.backend, self.backend_options, self.ring_specs())
+            )
+    
+    def stop_workers(self, timeout=5):
+        """Shut the pool down, terminating workers still running after timeout so a stuck one can't block exit"""
+        executor, self.executor = self.executor, None
+        # Process handles are only reachable through the executor
+        processes = list((getattr(executor, "_processes", None) or {}).values())
+        executor.shutdown(wait=not processes, cancel_futures=True)
+        deadline = time.time() + timeout
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                process.terminate()
+                process.join(1)
+    
+    def ring_specs(self):
+        """Return what workers need to attach to every source's frame ring"""
+        return {source: ring.spec() for source, ring in self.frame_rings.items()}
     
     def run(self, stop_flag):
-        """Run the inference service in a loop"""
-        self.event_queue.put({"type": "log", "message": "OpenCVモデル初期化中..."})
+        """Run the inference service, starting it again after a reset if the model or pool failed"""
+        while True:
+            self.restarting.clear()
+            self.failed = False
+            self.serve(stop_flag)
+            if stop_flag.is_set():
+                break
+            # Stay alive so a soft reset can load the model and start the pool again
+            self.failed = True
+            self.event_queue.put({"type": "log", "message": "推論停止 - リセット待機中"})
+            while not stop_flag.is_set() and not self.restarting.wait(1):
+                pass
+            if stop_flag.is_set():
+                break
+        self.in_flight.close()
+    
+    def serve(self, stop_flag):
+        """Load the model, start the workers and dispatch frames until stopped or failed"""
+        self.event_queue.put({"type": "log", "message": "推論モデル初期化中..."})
         
         try:
-            # Simple demo mode message
-            self.event_queue.put({"type": "log", "message": "GPUは未使用: デモモードでCPU実行"})
-            self.model_info = "OpenCV (デモモード)"
+            description = create_backend(self.backend, **self.backend_options).describe()
+            start_time = time.time()
+            self.start_workers()
+            workers = f"{self.num_workers}プロセス" if self.num_workers > 0 else "スレッド"
+            self.model_info = f"{description} x {workers}"
+            self.event_queue.put({"type": "log", "message": f"推論バックエンド: {self.model_info}"})
             
-            self.event_queue.put({"type": "log", "message": "モデル初期化完了"})
+            # Workers load and warm the model in their initializer; wait for all of them before reporting ready
+            pings = [self.executor.submit(ping_worker) for _ in range(max(self.num_workers, 1))]
+            while wait(pings, timeout=1).not_done:
+                if stop_flag.is_set():
+                    return
+            for ping in pings:
+                ping.result()
+            self.event_queue.put({"type": "log", "message": f"モデル初期化完了 ({int((time.time() - start_time) * 1000)}ms)"})
+            self.event_queue.put({"type": "ready", "component": "inference"})
             
-            # Main inference loop
+            # Main dispatch loop - results are released by collect()
             while not stop_flag.is_set():
-                try:
-                    # Get a frame from the queue
-                    frame_data = self.frame_queue.get(timeout=1)
-                    frame = frame_data["frame"]
-                    timestamp = frame_data["timestamp"]
-                    
-                    # Simple processing - just measure time
-                    start_time = time.time()
-                    
-                    # Apply basic OpenCV operations to simulate processing
-                    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
-                    blurred = cv2.GaussianBlur(gray, (5, 5), 0)
-                    
-                    # Demo detection - randomly detect items at intervals
-                    current_time = time.time()
-                    if current_time - self.last_detection_time > self.detection_interval:
-                        self.last_detection_time = current_time
-                        
-                        # Get frame dimensions
-                        h, w = frame.shape[:2]
-                        
-                        # Pick random food item
-                        class_idx = random.randint(0, len(FOOD_CLASSES) - 1)
-                        class_name = FOOD_CLASSES[class_idx]
-                        class_name_ja = FOOD_TRANSLATIONS[class_name]
-                        
-                        # Random bounding box (25-75% of frame size)
-                        box_w = random.uniform(0.25, 0.4) * w
-                        box_h = random.uniform(0.25, 0.4) * h
-                        box_x = random.uniform(0.1, 0.6) * w
-                        box_y = random.uniform(0.1, 0.6) * h
-                        
-                        # Random confidence (70-95%)
-                        confidence = random.uniform(0.7, 0.95)
-                        
-                        # Convert to percentage
-                        bbox = {
-                            "left": (box_x / w) * 100,
-                            "top": (box_y / h) * 100,
-                            "width": (box_w / w) * 100,
-                            "height": (box_h / h) * 100
-                        }
-                        
-                        # Create detection result
-                        detection = {
-                            "name": class_name_ja,
-                            "confidence": int(confidence * 100),
-                            "timestamp": timestamp,
-                            "bbox": bbox
-                        }
-                        
-                        try:
-                            self.result_queue.put(detection, block=False)
-                        except queue.Full:
-                            # Skip if queue is full
-                            pass
-                    
-                    # End timing
-                    inference_time = time.time() - start_time
-                    
-                    # Track inference time for metrics
-                    self.inference_times.append(inference_time)
-                    if len(self.inference_times) > 30:
-                        self.inference_times.pop(0)
-                    self.last_inference_time = inference_time
-                    
-                    # Update FPS calculation
-                    self.processed_frames += 1
-                    elapsed = time.time() - self.start_time
-                    if elapsed >= 1.0:
-                        self.fps = self.processed_frames / elapsed
-                        self.processed_frames = 0
-                        self.start_time = time.time()
-                
-                except queue.Empty:
-                    # No frames available, just continue
-                    pass
-                
-                # Don't hog the CPU
-                time.sleep(0.01)
+                batch = self.gate(self.collect_batch(timeout=1))
+                if batch:
+                    self.dispatch(self.lookup_cache(batch))
         
         except Exception as e:
             self.event_queue.put({"type": "log", "message": f"推論エラー: {str(e)}"})
+        
+        finally:
+            if self.executor is not None:
+                self.stop_workers()
+    
+    def reset(self):
+        """Forget per-source gate, tracker, cache and controller state; the warmed workers are kept.
+        
+        If the model or worker pool failed, they are started again.
+        """
+        if self.motion_gate is not None:
+            self.motion_gate.reset()
+        if self.tracker is not None:
+            self.tracker.reset()
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        if self.controller is not None:
+            self.controller.reset()
+        if self.failed:
+            self.restarting.set()
+    
+    def collect(self, stop_flag):
+        """Wait on dispatched batches in capture order and release their results"""
+        while not stop_flag.is_set() or not self.in_flight.empty():
+            try:
+                frames, future = self.in_flight.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.release_result(frames, future.result())
+            except CancelledError:
+                pass
+            except Exception as e:
+                self.event_queue.put({"type": "log", "message": f"推論エラー: {str(e)}"})
+    
+    def collect_batch(self, timeout):
+        """Collect up to batch_size frames, waiting at most batch_wait after the first"""
+        batch = []
+        try:
+            batch.append(self.frame_queue.get(timeout=timeout))
+        except queue.Empty:
+            return batch
+        
+        deadline = time.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    batch.append(self.frame_queue.get(timeout=remaining))
+                else:
+                    batch.append(self.frame_queue.get(block=False))
+            except queue.Empty:
+                break
+        
+        # Stamp when each frame left the frame queue
+        dequeued = time.time()
+        for frame in batch:
+            frame.dequeued = dequeued
+            registry.observe("frame_queue_wait", dequeued - frame.timestamp)
+        return batch
+    
+    def gate(self, batch):
+        """Drop frames the motion gate considers unchanged and pick the regions to run on the rest"""
+        if self.motion_gate is None and not self.regions and self.tiles == (1, 1):
+            return batch
+        
+        passed = []
+        for frame in batch:
+            source = frame.source
+            plan = self.region_plan(source)
+            motion = False
+            if self.motion_gate is None:
+                changed = plan
+            else:
+                image = self.frame_rings[source].view(frame.ref)
+                if image is None:
+                    # Already overwritten in the ring
+                    self.dropped_frames += 1
+                    continue
+                if plan is None:
+                    changed = self.motion_gate.check(source, image, frame.timestamp)
+                    motion = self.motion_gate.last_changed
+                    if changed and self.result_cache is not None:
+                        # Hash the gate's downscaled gray frame while it still holds this frame
+                        frame.hash = dhash(self.motion_gate.gray(source))
+                else:
+                    # Each region keeps its own background and keepalive
+                    changed = []
+                    for region in plan:
+                        x, y, w, h = region[1]
+                        if self.motion_gate.check((source, region[0]), image[y:y + h, x:x + w], frame.timestamp):
+                            changed.append(region)
+                            motion = motion or self.motion_gate.last_changed
+                if not changed:
+                    self.gated_frames += 1
+                    continue
+            
+            if motion and self.controller is not None:
+                self.controller.note_motion()
+            if plan is not None:
+                frame.rects = tuple(tile for region in changed for tile in region[2])
+                frame.partial = len(changed) < len(plan)
+            passed.append(frame)
+        return passed
+    
+    def region_plan(self, source):
+        """Return [(name, region rect, tile rects)] in pixels for a source, or None to run whole frames"""
+        if source not in self.region_plans:
+            regions = self.regions.get(source)
+            if not regions and self.tiles == (1, 1):
+                self.region_plans[source] = None
+            else:
+                ring = self.frame_rings[source]
+                plan = []
+                for name, region in regions or [("frame", (0.0, 0.0, 1.0, 1.0))]:
+                    rect = region_to_pixels(region, ring.width, ring.height)
+                    plan.append((name, rect, tile_rects(rect, self.tiles, self.tile_overlap)))
+                self.region_plans[source] = plan
+        return self.region_plans[source]
+    
+    def lookup_cache(self, batch):
+        """Attach cached detections to frames that look like a recently inferred one"""
+        if self.result_cache is None:
+            return batch
+        
+        for frame in batch:
+            if frame.partial:
+                # Only some regions will run, so its detections can't stand in for a whole frame
+                continue
+            if frame.hash is None:
+                image = self.frame_rings[frame.source].view(frame.ref)
+                if image is None:
+                    # Overwritten - left to the worker to report
+                    continue
+                frame.hash = self.result_cache.frame_hash(image)
+            frame.cached = self.result_cache.get(frame.source, frame.hash, frame.timestamp)
+        return batch
+    
+    def dispatch(self, batch):
+        """Send a batch of frames to the worker pool as one model call.
+        
+        Frames with cached detections are not sent, but keep their place in
+        the in-flight order so results are still released in capture order.
+        """
+        refs = [
+            (frame.source, frame.slot, frame.seq, frame.rects)
+            if frame.rects is not None else (frame.source, frame.slot, frame.seq)
+            for frame in batch if frame.cached is None
+        ]
+        if refs:
+            input_scale = self.controller.input_scale if self.controller is not None else 1.0
+            future = self.executor.submit(detect_in_worker, refs, input_scale)
+        else:
+            future = Future()
+            future.set_result((pack_detections([]), None, None))
+        self.in_flight.put((batch, future))
+    
+    def release_result(self, frames, result):
+        """Emit one finished batch's detections, split back out per frame"""
+        packed, inference_start, inference_end = result
+        batch_detections = unpack_detections(*packed)
+        if inference_start is not None:
+            registry.observe("inference", inference_end - inference_start)
+        inferred = iter(batch_detections)
+        
+        for frame in frames:
+            source, timestamp, dequeued = frame.source, frame.timestamp, frame.dequeued
+            if frame.cached is not None:
+                # Cache hit - the earlier frame's detections, re-stamped with this frame's time
+                detections = frame.cached
+                self.cached_frames += 1
+                trace = {"source": source, "capture": timestamp, "dequeue": dequeued,
+                         "inference_start": dequeued, "inference_end": dequeued, "cache_hit": True}
+            else:
+                detections = next(inferred)
+                trace = {"source": source, "capture": timestamp, "dequeue": dequeued,
+                         "inference_start": inference_start, "inference_end": inference_end}
+                if detections is not None and frame.hash is not None:
+                    # A copy, so the entry doesn't pin the whole packed batch
+                    self.result_cache.put(source, frame.hash, detections.copy(), timestamp)
+            if detections is None:
+                # Frame was overwritten in the ring before inference finished
+                self.dropped_frames += 1
+                continue
+            results = Detection.from_array(detections, source, timestamp, trace)
+            if self.tracker is not None:
+                regions = None
+                if frame.partial:
+                    # Only these regions ran; tracks elsewhere weren't looked for and must not age
+                    ring = self.frame_rings[source]
+                    regions = rects_to_percent(frame.rects, ring.width, ring.height)
+                results = self.tracker.update(source, timestamp, results, regions)
+            for detection in results:
+                try:
+                    # Blocks or drops according to the result channel's policy
+                    self.result_queue.put(detection)
+                except queue.Full:
+                    pass
+        
+        # Track per-frame inference time and batch latency for metrics
+        if inference_start is not None:
+            inference_time = (inference_end - inference_start) / len(batch_detections)
+            self.inference_times.append(inference_time)
+            self.last_inference_time = inference_time
+            self.batch_sizes.append(len(batch_detections))
+        now = time.time()
+        self.batch_latencies.append(now - min(frame.timestamp for frame in frames))
+        for frame in frames:
+            registry.observe("capture_to_result", now - frame.timestamp)
+            if self.controller is not None:
+                self.controller.observe(now - frame.timestamp)
+        
+        # Update FPS calculation
+        self.processed_frames += len(frames)
+        elapsed = time.time() - self.start_time
+        if elapsed >= 1.0:
+            self.fps = self.processed_frames / elapsed
+            self.processed_frames = 0
+            self.start_time = time.time()
     
     def get_model_info(self):
         """Return model information"""
@@ -159,3 +379,40 @@ class InferenceService:
     def get_fps(self):
         """Return the current FPS rate"""
         return self.fps
+    
+    def get_gate_stats(self):
+        """Return the share of frames the motion gate forwarded to the detector"""
+        if self.motion_gate is None:
+            return "無効"
+        return f"通過率 {self.motion_gate.get_pass_rate() * 100:.1f}%"
+    
+    def get_tracker_stats(self):
+        """Return active track count and how many detections tracking suppressed"""
+        if self.tracker is None:
+            return "無効"
+        return f"{self.tracker.get_active_count()} 個, 削減率 {self.tracker.get_reduction() * 100:.1f}%"
+    
+    def get_capture_stats(self):
+        """Return the capture controller's operating point"""
+        if self.controller is None:
+            return "無効"
+        return self.controller.get_stats()
+    
+    def get_cache_stats(self):
+        """Return the result cache hit rate, size and approximate memory"""
+        if self.result_cache is None:
+            return "無効"
+        cache = self.result_cache
+        return (
+            f"ヒット率 {cache.get_hit_rate() * 100:.1f}%, {len(cache.entries)}/{cache.max_entries} 件, "
+            f"{cache.get_memory() / 1024:.1f}KB"
+        )
+    
+    def get_batch_stats(self):
+        """Return average batch size, capture-to-result latency and throughput"""
+        if not self.batch_sizes:
+            return "0枚/バッチ, 0ms, 0.0 フレーム/秒"
+        
+        avg_size = sum(self.batch_sizes) / len(self.batch_sizes)
+        avg_latency = sum(self.batch_latencies) / len(self.batch_latencies)
+        return f"{avg_size:.1f}枚/バッチ, {int(avg_latency * 1000)}ms, {self.fps:.1f} フレーム/秒"
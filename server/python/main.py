@@ -1,100 +1,326 @@
 #!/usr/bin/env python3
+import time
+
+# Startup is timed from here, before the heavy imports
+PROCESS_START = time.time()
+
 import asyncio
 import json
 import sys
 import signal
-import time
-from stream_receiver import StreamReceiver
+# numpy and cv2 (about 60ms and 20ms of the ~165ms import) stay eager: the frame
+# rings are numpy arrays in shared memory allocated before any stage starts, and
+# capture and inference need cv2 on their first frame, so deferring them would
+# only move the cost to the first frame. Optional stages are imported lazily below.
+from stream_receiver import StreamReceiver, FairFrameQueue, parse_sources
 from inference_service import InferenceService
 from db_writer import DBWriter
 from api_server import APIServer
+from frame_ring import FrameRing
+from regions import parse_regions, parse_tiles
+from event_channel import EventChannel
+from pipeline import Pipeline, Channel
+from metrics import registry, TraceSampler, StartupTimer
 import queue
 import threading
 import os
 
-# Set up queues for communication between components
-frame_queue = queue.Queue(maxsize=30)  # Frames from camera to inference
-result_queue = queue.Queue(maxsize=30)  # Inference results to DB writer
-event_queue = queue.Queue()  # Events to be sent to clients
-
 # Flag to signal threads to stop
 stop_flag = threading.Event()
 
+# Set up channels for communication between components
+event_queue = Channel(name="events")  # Events to be sent to clients
+pipeline = Pipeline(stop_flag, event_queue)
+frame_queue = pipeline.add_channel(
+    "frames", FairFrameQueue(per_source_size=int(os.environ.get('FRAME_QUEUE_PER_SOURCE', 8)))
+)  # Frames from cameras to inference, drop-oldest per source
+result_queue = pipeline.channel(
+    "results", maxsize=30, policy=os.environ.get('RESULT_QUEUE_POLICY', 'block')
+)  # Inference results to DB writer
+
+# Newline-delimited event stream read by the Node.js server
+event_channel = EventChannel(serializer=os.environ.get('EVENT_SERIALIZER', 'json'))
+
+# Queue depth/drop gauges and an optional sampled trace dump for offline analysis
+registry.add_gauges(pipeline.get_channel_stats)
+trace_sampler = TraceSampler(os.environ.get('TRACE_FILE'), float(os.environ.get('TRACE_SAMPLE_RATE', 0.01)))
+
+# Time to every component's ready event and to the first detection; components are added as stages are built
+IMPORT_TIME = time.time() - PROCESS_START
+startup = StartupTimer(PROCESS_START, [])
+
 def signal_handler(sig, frame):
     """Handle termination signals gracefully"""
-    print(json.dumps({"type": "log", "message": "Shutting down..."}))
+    event_queue.put({"type": "log", "message": "Shutting down..."})
     stop_flag.set()
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
 def print_json(data):
-    """Print JSON data that can be captured by the Node.js server"""
-    print(json.dumps(data), flush=True)
+    """Send a single event to the Node.js server"""
+    event_channel.send(data)
+
+def drain_events(timeout, max_events=1000):
+    """Wait up to timeout for an event, then take everything else already queued"""
+    events = []
+    try:
+        events.append(event_queue.get(timeout=timeout) if timeout > 0 else event_queue.get(block=False))
+        while len(events) < max_events:
+            events.append(event_queue.get(block=False))
+    except queue.Empty:
+        pass
+    return events
+
+def read_commands(inference_service):
+    """Read newline-delimited JSON commands from the Node.js server on stdin.
+    
+    Reads fd 0 directly: a thread blocked in sys.stdin holds its buffer lock,
+    and forked pool workers close sys.stdin on start, waiting on that lock forever.
+    """
+    pending = b""
+    while True:
+        chunk = os.read(0, 4096)
+        if not chunk:
+            return
+        *lines, pending = (pending + chunk).split(b"\n")
+        for line in lines:
+            try:
+                command = json.loads(line)
+            except ValueError:
+                continue
+            if command.get("action") == "soft_reset":
+                soft_reset(inference_service)
+
+def soft_reset(inference_service):
+    """Restart the stages in place, keeping imports, worker processes and loaded models"""
+    event_queue.put({"type": "log", "message": "ソフトリセット実行中..."})
+    # The reopened sources, and a failed inference pool being restarted, report ready again;
+    # components that never became ready are still waited for
+    restarted = {name for name in startup.expected if name.startswith("stream_receiver")}
+    if inference_service.failed:
+        restarted.add("inference")
+    startup.restart(startup.pending | restarted)
+    names = pipeline.reset()
+    event_queue.put({"type": "log", "message": f"ソフトリセット完了 ({', '.join(names)})"})
+
+def track_startup(events):
+    """Record ready events and the first detection, announcing when every component is ready"""
+    for event in list(events):
+        event_type = event.get("type")
+        if event_type == "ready":
+            component = event["component"] + (f":{event['source']}" if event.get("source") else "")
+            if startup.mark_ready(component):
+                events.append({"type": "log", "message": f"システム準備完了 ({startup.describe()})"})
+                events.append({"type": "ready", "component": "system", "startup": startup.snapshot()})
+        elif event_type in ("item_added", "item_updated"):
+            startup.mark_detection()
+
+def finish_traces(events):
+    """Strip internal stage traces from events, recording emit latency"""
+    now = time.time()
+    for event in events:
+        trace = event.pop("trace", None)
+        if not trace:
+            continue
+        trace["emit"] = now
+        registry.observe("event_emit", now - trace.get("db_commit", trace["inference_end"]))
+        registry.observe("end_to_end", now - trace["capture"])
+        trace_sampler.maybe_record(trace)
+
+def build_system_stats(db_writer, inference_service, history=None):
+    """Build the periodic system_stats event"""
+    return {
+        "type": "system_stats",
+        "stats": {
+            "connectionState": "オンライン",
+            "wsStatus": "接続済",
+            "recognizedCount": f"{db_writer.get_item_count()} 個",
+            "queueStatus": f"{frame_queue.qsize()}/{frame_queue.maxsize}",
+            "modelInfo": inference_service.get_model_info(),
+            "inferenceSpeed": inference_service.get_inference_speed(),
+            "processingStatus": f"処理中: {inference_service.get_fps():.1f} フレーム/秒",
+            "inferenceBatch": inference_service.get_batch_stats(),
+            "motionGate": inference_service.get_gate_stats(),
+            "tracks": inference_service.get_tracker_stats(),
+            "inferenceCache": inference_service.get_cache_stats(),
+            "captureControl": inference_service.get_capture_stats(),
+            "dbFlush": db_writer.get_flush_stats(),
+            "detectionHistory": history.get_stats() if history is not None else "無効",
+            "startup": startup.describe()
+        },
+        # Numeric per-stage percentiles and queue depth/drop counters
+        "metrics": registry.snapshot(),
+        "startup": dict(startup.snapshot(), import_ms=round(IMPORT_TIME * 1000, 1))
+    }
 
 async def main():
     try:
         # Initialize components
         print_json({"type": "log", "message": "システム起動中"})
         
-        # Start DB writer in a thread
-        db_writer = DBWriter(result_queue, event_queue)
-        db_thread = threading.Thread(target=db_writer.run, args=(stop_flag,))
-        db_thread.daemon = True
-        db_thread.start()
+        # Camera, RTSP or video file sources, one per fridge
+        sources = parse_sources(os.environ.get('CAMERA_SOURCES', 'default=0'))
         
-        # Start inference service in a thread
-        inference_service = InferenceService(frame_queue, result_queue, event_queue)
-        inference_thread = threading.Thread(target=inference_service.run, args=(stop_flag,))
-        inference_thread.daemon = True
-        inference_thread.start()
+        # Shared memory frame slots per source between the stream receiver and inference workers
+        frame_rings = {
+            source["id"]: FrameRing(
+                int(os.environ.get('FRAME_RING_SLOTS', 16)),
+                int(os.environ.get('FRAME_HEIGHT', 720)),
+                int(os.environ.get('FRAME_WIDTH', 1280))
+            )
+            for source in sources
+        }
         
-        # Start stream receiver in a thread
-        stream_receiver = StreamReceiver(frame_queue, event_queue)
-        stream_thread = threading.Thread(target=stream_receiver.run, args=(stop_flag,))
-        stream_thread.daemon = True
-        stream_thread.start()
+        # DB writer stage
+        db_writer = DBWriter(
+            result_queue,
+            event_queue,
+            batch_size=int(os.environ.get('DB_BATCH_SIZE', 64)),
+            flush_interval=int(os.environ.get('DB_FLUSH_INTERVAL_MS', 50)) / 1000,
+            last_seen_resolution=float(os.environ.get('DB_LAST_SEEN_RESOLUTION', 30)),
+            writers=int(os.environ.get('DB_WRITERS', 2)),
+            change_log_size=int(os.environ.get('INVENTORY_CHANGE_LOG', 1024))
+        )
+        pipeline.stage("db_writer", db_writer.run, consumes=["results"], reset=db_writer.reset)
+        startup.expect("db_writer")
+        # Writer queues stay open past pipeline.stop() so queued batches are still written
+        registry.add_gauges(db_writer.get_write_queue_stats)
         
-        # Start API server for forwarding events
-        api_server = APIServer(event_queue)
-        server_thread = threading.Thread(target=api_server.run, args=(stop_flag,))
-        server_thread.daemon = True
-        server_thread.start()
+        # Detection history - every detection appended to daily partitions, rolled up hourly
+        history = None
+        if os.environ.get('DETECTION_HISTORY', '1') != '0':
+            # Optional stages are only imported when enabled
+            from detection_history import DetectionHistory
+            history = DetectionHistory(
+                db_writer.pool,
+                event_queue,
+                retention_days=int(os.environ.get('HISTORY_RETENTION_DAYS', 30)),
+                rollup_interval=float(os.environ.get('HISTORY_ROLLUP_INTERVAL', 300))
+            )
+            db_writer.history = history
+            pipeline.stage("detection_history", history.run)
+            startup.expect("detection_history")
         
-        # Event monitoring loop
+        # Inference stages - dispatch to the worker pool, then release results in order
+        backend_options = {"confidence_threshold": float(os.environ.get('INFERENCE_CONFIDENCE', 0.5))}
+        if os.environ.get('INFERENCE_MODEL'):
+            backend_options["model_path"] = os.environ['INFERENCE_MODEL']
+        if os.environ.get('INFERENCE_LABELS'):
+            # ONNX output class order, e.g. "person,bicycle,..."; read from the export's metadata otherwise
+            backend_options["labels"] = [label.strip() for label in os.environ['INFERENCE_LABELS'].split(",")]
+        motion_gate = None
+        if os.environ.get('MOTION_GATE', '1') != '0':
+            from motion_gate import MotionGate
+            motion_gate = MotionGate(
+                pixel_threshold=int(os.environ.get('MOTION_PIXEL_THRESHOLD', 25)),
+                changed_fraction=float(os.environ.get('MOTION_CHANGED_FRACTION', 0.01)),
+                keepalive=float(os.environ.get('MOTION_KEEPALIVE', 10))
+            )
+        # Demo detections are one-off random boxes that would never confirm a track
+        backend = os.environ.get('INFERENCE_BACKEND', 'demo')
+        tracker = None
+        if os.environ.get('TRACKER', '0' if backend == 'demo' else '1') != '0':
+            from tracker import ObjectTracker
+            tracker = ObjectTracker(
+                min_hits=int(os.environ.get('TRACKER_MIN_HITS', 3)),
+                max_misses=int(os.environ.get('TRACKER_MAX_MISSES', 15)),
+                refresh_interval=float(os.environ.get('DB_LAST_SEEN_RESOLUTION', 30))
+            )
+        # Result cache - near-identical frames reuse recent detections; demo detections are random, so off by default
+        result_cache = None
+        if os.environ.get('INFERENCE_CACHE', '0' if backend == 'demo' else '1') != '0':
+            from result_cache import ResultCache
+            result_cache = ResultCache(
+                max_entries=int(os.environ.get('INFERENCE_CACHE_SIZE', 256)),
+                ttl=float(os.environ.get('INFERENCE_CACHE_TTL', 5)),
+                max_distance=int(os.environ.get('INFERENCE_CACHE_DISTANCE', 4))
+            )
+        # Capture controller - trades frame rate and model input size for stable latency under load
+        controller = None
+        if os.environ.get('ADAPTIVE_CAPTURE', '1') != '0':
+            from capture_controller import CaptureController, parse_levels, DEFAULT_LEVELS
+            controller = CaptureController(
+                frame_queue,
+                levels=parse_levels(os.environ['CAPTURE_LEVELS']) if os.environ.get('CAPTURE_LEVELS') else DEFAULT_LEVELS,
+                target_latency=int(os.environ.get('CAPTURE_TARGET_LATENCY_MS', 500)) / 1000,
+                interval=float(os.environ.get('CAPTURE_CONTROL_INTERVAL', 1))
+            )
+            pipeline.stage("capture_control", controller.run)
+        inference_service = InferenceService(
+            frame_queue,
+            result_queue,
+            event_queue,
+            frame_rings,
+            backend=backend,
+            num_workers=int(os.environ.get('INFERENCE_WORKERS', 2)),
+            backend_options=backend_options,
+            batch_size=int(os.environ.get('INFERENCE_BATCH_SIZE', 4)),
+            batch_wait=int(os.environ.get('INFERENCE_BATCH_WAIT_MS', 20)) / 1000,
+            motion_gate=motion_gate,
+            tracker=tracker,
+            controller=controller,
+            result_cache=result_cache,
+            # Shelf/door regions per source and an optional tile grid for small items in large frames
+            regions=parse_regions(os.environ.get('CAMERA_REGIONS')),
+            tiles=parse_tiles(os.environ.get('INFERENCE_TILES', '1x1')),
+            tile_overlap=float(os.environ.get('INFERENCE_TILE_OVERLAP', 0.2))
+        )
+        pipeline.add_channel("in_flight", inference_service.in_flight)
+        pipeline.stage("inference", inference_service.run, consumes=["frames"], produces=["in_flight"],
+                       reset=inference_service.reset)
+        startup.expect("inference")
+        pipeline.stage("inference_results", inference_service.collect, consumes=["in_flight"], produces=["results"])
+        
+        # Stream receiver stage - one capture thread per source
+        stream_receiver = StreamReceiver(frame_queue, event_queue, frame_rings, sources, controller=controller)
+        pipeline.stage("stream_receiver", stream_receiver.run, produces=["frames"], reset=stream_receiver.reset)
+        startup.expect(*(f"stream_receiver:{source['id']}" for source in sources))
+        
+        # API server streaming events and item snapshots to its own subscribers
+        # Only the local Node.js server talks to it by default; API_HOST=0.0.0.0 exposes it (no auth)
+        api_server = APIServer(
+            event_queue, db_writer,
+            host=os.environ.get('API_HOST', '127.0.0.1'),
+            port=int(os.environ.get('API_PORT', 8765))
+        )
+        pipeline.stage("api_server", api_server.run)
+        startup.expect("api_server")
+        
+        pipeline.start()
+        # Commands (soft reset) from the Node.js server; daemon so a silent stdin never blocks shutdown
+        threading.Thread(target=read_commands, args=(inference_service,), name="commands", daemon=True).start()
+        
+        # Event forwarding loop - drain everything queued each tick and send it as one batch
+        next_stats_time = time.time()
         while not stop_flag.is_set():
             try:
-                if not event_queue.empty():
-                    event = event_queue.get(block=False)
-                    print_json(event)
+                events = await asyncio.to_thread(drain_events, next_stats_time - time.time())
                 
                 # Report system status periodically
-                system_stats = {
-                    "type": "system_stats",
-                    "stats": {
-                        "connectionState": "オンライン",
-                        "wsStatus": "接続済",
-                        "recognizedCount": f"{db_writer.get_item_count()} 個",
-                        "queueStatus": f"{frame_queue.qsize()}/{frame_queue.maxsize}",
-                        "modelInfo": inference_service.get_model_info(),
-                        "inferenceSpeed": inference_service.get_inference_speed(),
-                        "processingStatus": f"処理中: {inference_service.get_fps():.1f} フレーム/秒"
-                    }
-                }
-                print_json(system_stats)
-                await asyncio.sleep(1)
-            except queue.Empty:
-                await asyncio.sleep(0.1)
+                if time.time() >= next_stats_time:
+                    events.append(build_system_stats(db_writer, inference_service, history))
+                    next_stats_time = time.time() + 1
+                
+                track_startup(events)
+                finish_traces(events)
+                # Serialized once; the API server reuses the bytes written to Node
+                payloads = event_channel.serialize(events)
+                api_server.publish(events, payloads)
+                event_channel.send_payloads(payloads)
             except Exception as e:
                 print_json({"type": "log", "message": f"エラー: {str(e)}"})
                 await asyncio.sleep(1)
         
-        # Wait for threads to finish
+        # Wake every blocked stage and wait for them to finish
         print_json({"type": "log", "message": "システム停止中..."})
-        db_thread.join(timeout=2)
-        inference_thread.join(timeout=2)
-        stream_thread.join(timeout=2)
-        server_thread.join(timeout=2)
+        pipeline.stop(timeout=8)
+        events = drain_events(0)
+        finish_traces(events)
+        event_channel.send_batch(events)
+        trace_sampler.close()
+        for frame_ring in frame_rings.values():
+            frame_ring.close()
         
     except Exception as e:
         print_json({"type": "log", "message": f"致命的なエラー: {str(e)}"})
@@ -0,0 +1,185 @@
+import json
+import random
+import threading
+import time
+import numpy as np
+
+class RollingHistogram:
+    """Fixed window of the most recent samples, summarized as percentiles.
+    
+    record() is a single slot write plus a counter bump, so stage threads never
+    take a lock on the hot path; percentiles are computed when read.
+    """
+    
+    def __init__(self, size=1024):
+        self.size = size
+        self.values = np.zeros(size, dtype=np.float64)
+        self.count = 0
+    
+    def record(self, value):
+        self.values[self.count % self.size] = value
+        self.count += 1
+    
+    def percentiles(self, quantiles=(50, 95, 99)):
+        """Return the requested percentiles over the window, or zeros if empty"""
+        n = min(self.count, self.size)
+        if n == 0:
+            return [0.0] * len(quantiles)
+        return [float(v) for v in np.percentile(self.values[:n], quantiles)]
+
+class MetricsRegistry:
+    """Per-stage latency histograms plus gauges gathered from callbacks"""
+    
+    def __init__(self, window=1024):
+        self.window = window
+        self.histograms = {}
+        self.gauge_providers = []
+    
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms.setdefault(name, RollingHistogram(self.window))
+        return histogram
+    
+    def observe(self, name, seconds):
+        """Record a latency sample for a stage"""
+        self.histogram(name).record(seconds)
+    
+    def add_gauges(self, provider):
+        """Register a callable returning {queue_name: {"depth", "capacity", "dropped"}}"""
+        self.gauge_providers.append(provider)
+    
+    def gauges(self):
+        gauges = {}
+        for provider in self.gauge_providers:
+            gauges.update(provider())
+        return gauges
+    
+    def snapshot(self):
+        """Return every metric as plain numbers (milliseconds for latencies)"""
+        stages = {}
+        for name, histogram in list(self.histograms.items()):
+            p50, p95, p99 = histogram.percentiles()
+            stages[name] = {
+                "p50_ms": round(p50 * 1000, 2),
+                "p95_ms": round(p95 * 1000, 2),
+                "p99_ms": round(p99 * 1000, 2),
+                "count": histogram.count
+            }
+        return {"stages": stages, "queues": self.gauges()}
+    
+    def prometheus(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = [
+            "# HELP fridge_stage_latency_seconds Rolling per-stage latency percentiles",
+            "# TYPE fridge_stage_latency_seconds summary"
+        ]
+        for name, histogram in list(self.histograms.items()):
+            for quantile, value in zip(("0.5", "0.95", "0.99"), histogram.percentiles()):
+                lines.append(f'fridge_stage_latency_seconds{{stage="{name}",quantile="{quantile}"}} {value:.6f}')
+            lines.append(f'fridge_stage_latency_seconds_count{{stage="{name}"}} {histogram.count}')
+        
+        gauges = self.gauges()
+        for metric, field, kind in (
+            ("fridge_queue_depth", "depth", "gauge"),
+            ("fridge_queue_capacity", "capacity", "gauge"),
+            ("fridge_queue_dropped_total", "dropped", "counter"),
+        ):
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, values in gauges.items():
+                lines.append(f'{metric}{{queue="{name}"}} {values[field]}')
+        return "\n".join(lines) + "\n"
+
+class TraceSampler:
+    """Appends a sample of per-detection stage timestamps to a JSON lines file"""
+    
+    def __init__(self, path, sample_rate=0.01):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8") if path else None
+    
+    def maybe_record(self, trace):
+        if self.file is None or random.random() >= self.sample_rate:
+            return
+        line = json.dumps(trace) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+class StartupTimer:
+    """Startup milestones relative to process start (or the last soft reset).
+    
+    Components report readiness with {"type": "ready", "component": ...}
+    events; startup is complete once every expected component has. The first
+    emitted detection after that start is recorded as time to first detection.
+    """
+    
+    def __init__(self, start, components):
+        self.start = start
+        self.expected = set(components)
+        self.pending = set(components)
+        self.ready_times = {}
+        self.ready_time = None
+        self.first_detection_time = None
+        self.resets = 0
+    
+    def expect(self, *components):
+        """Add components that must report ready before startup is complete"""
+        self.expected.update(components)
+        self.pending.update(components)
+    
+    def mark_ready(self, component, now=None):
+        """Record a ready event, returning True when it was the last expected component"""
+        now = time.time() if now is None else now
+        self.ready_times[component] = now - self.start
+        if component not in self.pending:
+            return False
+        self.pending.discard(component)
+        if self.pending:
+            return False
+        self.ready_time = now - self.start
+        return True
+    
+    def mark_detection(self, now=None):
+        if self.first_detection_time is None:
+            self.first_detection_time = (time.time() if now is None else now) - self.start
+    
+    def restart(self, components, now=None):
+        """Start timing again after a soft reset, waiting for the given components to report ready"""
+        self.start = time.time() if now is None else now
+        self.pending = set(components)
+        self.ready_times = {}
+        self.ready_time = None
+        self.first_detection_time = None
+        self.resets += 1
+    
+    def snapshot(self):
+        """Return the milestones in milliseconds; None for ones not reached yet"""
+        def to_ms(seconds):
+            return None if seconds is None else round(seconds * 1000, 1)
+        
+        return {
+            "ready_ms": to_ms(self.ready_time),
+            "first_detection_ms": to_ms(self.first_detection_time),
+            "components_ms": {name: to_ms(seconds) for name, seconds in self.ready_times.items()},
+            "pending": sorted(self.pending),
+            "resets": self.resets
+        }
+    
+    def describe(self):
+        """Return startup and time to first detection for system_stats"""
+        if self.ready_time is None:
+            return f"起動中 ({', '.join(sorted(self.pending))})"
+        text = f"起動 {self.ready_time * 1000:.0f}ms"
+        if self.first_detection_time is not None:
+            text += f", 初回検出 {self.first_detection_time * 1000:.0f}ms"
+        return text
+
+# Process-wide registry shared by every stage
+registry = MetricsRegistry()
@@ -0,0 +1,81 @@
+import time
+import numpy as np
+import cv2
+
+class MotionGate:
+    """Decides per source whether a frame changed enough to be worth running the detector on.
+    
+    Frames are downscaled to a small gray image and compared against a running
+    background average. A frame passes when enough pixels differ from the
+    background, or when keepalive seconds have passed since the last one.
+    """
+    
+    def __init__(self, width=160, height=90, pixel_threshold=25, changed_fraction=0.01, keepalive=10,
+                 learning_rate=0.05):
+        self.width = width
+        self.height = height
+        self.pixel_threshold = pixel_threshold
+        self.changed_pixels = int(width * height * changed_fraction)
+        self.keepalive = keepalive
+        self.learning_rate = learning_rate
+        # Per-source preallocated buffers and background
+        self.states = {}
+        self.checked_frames = 0
+        self.passed_frames = 0
+        # Whether the last checked frame differed from the background (not just a keepalive)
+        self.last_changed = False
+    
+    def state_for(self, source):
+        """Return the buffers for a source, creating them on first use"""
+        state = self.states.get(source)
+        if state is None:
+            state = self.states[source] = {
+                "small": np.empty((self.height, self.width, 3), dtype=np.uint8),
+                "gray": np.empty((self.height, self.width), dtype=np.uint8),
+                "diff": np.empty((self.height, self.width), dtype=np.uint8),
+                "background": None,
+                "last_pass_time": 0
+            }
+        return state
+    
+    def check(self, source, frame, timestamp=None):
+        """Update the source's background with a BGR frame and return whether it should be inferred"""
+        timestamp = time.time() if timestamp is None else timestamp
+        state = self.state_for(source)
+        
+        # Cheap change detector on a downscaled, blurred gray frame
+        cv2.resize(frame, (self.width, self.height), dst=state["small"], interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(state["small"], cv2.COLOR_BGR2GRAY, dst=state["gray"])
+        cv2.GaussianBlur(state["gray"], (5, 5), 0, dst=state["gray"])
+        
+        self.checked_frames += 1
+        if state["background"] is None:
+            state["background"] = state["gray"].astype(np.float32)
+            changed = True
+        else:
+            cv2.absdiff(state["gray"], state["background"].astype(np.uint8), dst=state["diff"])
+            changed = cv2.countNonZero(
+                cv2.threshold(state["diff"], self.pixel_threshold, 255, cv2.THRESH_BINARY, dst=state["diff"])[1]
+            ) >= self.changed_pixels
+            cv2.accumulateWeighted(state["gray"], state["background"], self.learning_rate)
+        self.last_changed = changed
+        
+        if changed or timestamp - state["last_pass_time"] >= self.keepalive:
+            state["last_pass_time"] = timestamp
+            self.passed_frames += 1
+            return True
+        return False
+    
+    def reset(self):
+        """Drop every background so the next frame of each source passes"""
+        self.states = {}
+    
+    def gray(self, source):
+        """Return the downscaled, blurred gray image of the source's last checked frame"""
+        return self.states[source]["gray"]
+    
+    def get_pass_rate(self):
+        """Return the fraction of frames forwarded to the detector"""
+        if not self.checked_frames:
+            return 0.0
+        return self.passed_frames / self.checked_frames
@@ -0,0 +1,222 @@
+import queue
+import threading
+import time
+from collections import deque
+
+# Backpressure policies for a full channel
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+class ChannelClosed(queue.Empty):
+    """Raised by get() once a channel is closed and drained.
+    
+    Subclasses queue.Empty so stage loops that already handle an empty queue
+    fall through to their stop_flag check.
+    """
+    pass
+
+class Channel:
+    """Bounded FIFO between pipeline stages with an explicit backpressure policy.
+    
+    Works as a drop-in for queue.Queue: consumers block on data rather than
+    polling, and close() wakes every waiter for a coordinated shutdown.
+    """
+    
+    def __init__(self, maxsize=0, policy=BLOCK, name=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown backpressure policy: {policy}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.name = name
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.closed = False
+        self.dropped = 0
+    
+    def qsize(self):
+        with self.lock:
+            return len(self.items)
+    
+    def empty(self):
+        return self.qsize() == 0
+    
+    def full(self):
+        with self.lock:
+            return 0 < self.maxsize <= len(self.items)
+    
+    def put(self, item, block=True, timeout=None):
+        """Add an item, applying the channel's policy when full.
+        
+        Returns False if the item was dropped. Raises queue.Full only for the
+        block policy when block is False or the timeout expires.
+        """
+        with self.not_full:
+            if self.closed:
+                return False
+            if 0 < self.maxsize <= len(self.items):
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.policy == DROP_OLDEST:
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    if not block:
+                        raise queue.Full
+                    if not self.not_full.wait_for(lambda: self.closed or len(self.items) < self.maxsize, timeout):
+                        raise queue.Full
+                    if self.closed:
+                        return False
+            self.items.append(item)
+            self.not_empty.notify()
+            return True
+    
+    def get(self, block=True, timeout=None):
+        """Remove and return the next item, waiting for one if needed"""
+        with self.not_empty:
+            if block:
+                self.not_empty.wait_for(lambda: self.items or self.closed, timeout)
+            if self.items:
+                item = self.items.popleft()
+                self.not_full.notify()
+                return item
+            if self.closed:
+                raise ChannelClosed
+            raise queue.Empty
+    
+    def close(self):
+        """Stop accepting items and wake every waiting producer and consumer"""
+        with self.lock:
+            self.closed = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+class Stage:
+    """A named pipeline stage run by one or more worker threads.
+    
+    target is called as target(stop_flag) in each worker. consumes/produces
+    name the channels the stage reads and writes, which order shutdown.
+    reset, if given, is called on a soft reset to restart the stage's work
+    in place. Stages that need process parallelism own their pool (see
+    InferenceService).
+    """
+    
+    def __init__(self, name, target, workers=1, consumes=(), produces=(), reset=None):
+        self.name = name
+        self.target = target
+        self.reset = reset
+        self.workers = workers
+        self.consumes = tuple(consumes)
+        self.produces = tuple(produces)
+        self.threads = []
+
+class Pipeline:
+    """Runs stages connected by channels and shuts them down together"""
+    
+    def __init__(self, stop_flag, event_queue=None):
+        self.stop_flag = stop_flag
+        self.event_queue = event_queue
+        self.channels = {}
+        self.stages = []
+    
+    def channel(self, name, maxsize=0, policy=BLOCK):
+        """Create and register a channel"""
+        return self.add_channel(name, Channel(maxsize, policy, name))
+    
+    def add_channel(self, name, channel):
+        """Register an existing channel-like object so it is closed on shutdown"""
+        self.channels[name] = channel
+        return channel
+    
+    def stage(self, name, target, workers=1, consumes=(), produces=(), reset=None):
+        """Declare a stage; it starts with start()"""
+        stage = Stage(name, target, workers, consumes, produces, reset)
+        self.stages.append(stage)
+        return stage
+    
+    def start(self):
+        """Start every stage's workers, downstream stages first"""
+        for stage in reversed(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self.run_worker, args=(stage,), name=f"{stage.name}-{i}")
+                thread.daemon = True
+                thread.start()
+                stage.threads.append(thread)
+    
+    def run_worker(self, stage):
+        try:
+            stage.target(self.stop_flag)
+        except Exception as e:
+            if self.event_queue is not None:
+                self.event_queue.put({"type": "log", "message": f"ステージエラー ({stage.name}): {str(e)}"})
+    
+    def reset(self):
+        """Soft reset: have every resettable stage restart in place, in declaration order.
+        
+        Threads, channels and worker processes (with their loaded models) are
+        kept, so this skips the import and model load a process restart pays.
+        Returns the names of the stages that were reset.
+        """
+        names = []
+        for stage in self.stages:
+            if stage.reset is None:
+                continue
+            try:
+                stage.reset()
+                names.append(stage.name)
+            except Exception as e:
+                if self.event_queue is not None:
+                    self.event_queue.put({"type": "log", "message": f"リセットエラー ({stage.name}): {str(e)}"})
+        return names
+    
+    def stop(self, timeout=2):
+        """Signal stop and shut the stages down upstream first, waiting at most timeout in total.
+        
+        For each stage, its input channels are closed, its workers joined,
+        and only then are the channels it produces closed, so items still in
+        flight reach the next stage instead of a closed channel. Stages with
+        no declared channels are joined last.
+        """
+        self.stop_flag.set()
+        deadline = time.time() + timeout
+        for stage in self.shutdown_order():
+            self.close_channels(stage.consumes)
+            for thread in stage.threads:
+                thread.join(timeout=max(deadline - time.time(), 0))
+            self.close_channels(stage.produces)
+        self.close_channels(self.channels)
+        for stage in self.stages:
+            if not stage.consumes and not stage.produces:
+                for thread in stage.threads:
+                    thread.join(timeout=max(deadline - time.time(), 0))
+    
+    def shutdown_order(self):
+        """Stages with declared channels, each after the stages producing its inputs"""
+        remaining = [stage for stage in self.stages if stage.consumes or stage.produces]
+        order = []
+        while remaining:
+            produced = {name for stage in remaining for name in stage.produces}
+            ready = [stage for stage in remaining if not produced.intersection(stage.consumes)] or remaining[:1]
+            order.extend(ready)
+            remaining = [stage for stage in remaining if stage not in ready]
+        return order
+    
+    def close_channels(self, names):
+        for name in names:
+            channel = self.channels.get(name)
+            if channel is not None and hasattr(channel, "close"):
+                channel.close()
+    
+    def get_channel_stats(self):
+        """Return depth, capacity and drop count per channel"""
+        stats = {}
+        for name, channel in self.channels.items():
+            dropped = getattr(channel, "dropped", 0)
+            if isinstance(dropped, dict):
+                dropped = sum(dropped.values())
+            stats[name] = {"depth": channel.qsize(), "capacity": channel.maxsize, "dropped": dropped}
+        return stats
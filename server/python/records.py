@@ -0,0 +1,139 @@
+import numpy as np
+from food_classes import FOOD_CLASSES, FOOD_TRANSLATIONS
+
+# Classes travel as indexes into FOOD_CLASSES; names are only resolved where
+# JSON events or database rows are produced
+CLASS_IDS = {class_name: class_id for class_id, class_name in enumerate(FOOD_CLASSES)}
+CLASS_NAMES = tuple(FOOD_TRANSLATIONS[class_name] for class_name in FOOD_CLASSES)
+
+# One row per detection; boxes are left/top/width/height fractions of the frame.
+# Source and capture time are the same for every row of a frame, so they stay
+# on the Frame instead of being repeated per row.
+DETECTION_DTYPE = np.dtype([
+    ("class_id", np.uint16),
+    ("conf", np.float32),
+    ("x", np.float32),
+    ("y", np.float32),
+    ("w", np.float32),
+    ("h", np.float32),
+])
+
+def empty_detections(size=0):
+    return np.zeros(size, dtype=DETECTION_DTYPE)
+
+def detections_from_columns(class_ids, conf, x, y, w, h):
+    """Build a DETECTION_DTYPE array from per-field columns"""
+    detections = empty_detections(len(class_ids))
+    detections["class_id"] = class_ids
+    detections["conf"] = conf
+    detections["x"] = x
+    detections["y"] = y
+    detections["w"] = w
+    detections["h"] = h
+    return detections
+
+def as_detections(raw):
+    """Convert backend output to a DETECTION_DTYPE array.
+    
+    Backends may return the array directly, or (class_name, confidence, left,
+    top, width, height) tuples; classes outside FOOD_CLASSES are dropped.
+    """
+    if isinstance(raw, np.ndarray):
+        return raw
+    rows = [(CLASS_IDS[row[0]], *row[1:]) for row in raw if row[0] in CLASS_IDS]
+    if not rows:
+        return empty_detections()
+    return detections_from_columns(*np.array(rows, dtype=np.float64).T)
+
+def pack_detections(batch_detections):
+    """Join a batch's per-frame arrays (or None) into raw row bytes and per-frame counts.
+    
+    Plain bytes cross the worker pipe without pickling a dtype for every
+    array; unpack_detections rebuilds the arrays without copying.
+    """
+    counts = [-1 if detections is None else len(detections) for detections in batch_detections]
+    arrays = [detections for detections in batch_detections if detections is not None]
+    return np.concatenate(arrays).tobytes() if arrays else b"", counts
+
+def unpack_detections(packed, counts):
+    """Split a packed batch back into per-frame read-only arrays, None for dropped frames"""
+    rows = np.frombuffer(packed, dtype=DETECTION_DTYPE)
+    batch_detections = []
+    offset = 0
+    for count in counts:
+        if count < 0:
+            batch_detections.append(None)
+        else:
+            batch_detections.append(rows[offset:offset + count])
+            offset += count
+    return batch_detections
+
+class Frame:
+    """Reference to a captured frame in its source's ring, plus what each stage learned about it"""
+    __slots__ = ("source", "slot", "seq", "timestamp", "dequeued", "hash", "cached", "rects", "partial")
+    
+    def __init__(self, source, slot, seq, timestamp):
+        self.source = source
+        self.slot = slot
+        self.seq = seq
+        self.timestamp = timestamp
+        # Set by the inference stages
+        self.dequeued = None
+        self.hash = None
+        self.cached = None
+        self.rects = None
+        self.partial = False
+    
+    @property
+    def ref(self):
+        """(slot, seq) reference into the source's FrameRing"""
+        return self.slot, self.seq
+
+class Detection:
+    """One detection on its way from inference to the DB writer.
+    
+    The box stays as fractions and the class as an id; name, confidence and
+    bbox are computed on access for the JSON and database edges.
+    """
+    __slots__ = ("source", "class_id", "score", "timestamp", "left", "top", "width", "height", "track_id", "trace")
+    
+    def __init__(self, source, class_id, score, timestamp, left, top, width, height, trace=None):
+        self.source = source
+        self.class_id = class_id
+        self.score = score
+        self.timestamp = timestamp
+        self.left = left
+        self.top = top
+        self.width = width
+        self.height = height
+        self.track_id = None
+        # Stage timestamps; internal only
+        self.trace = trace
+    
+    @classmethod
+    def from_array(cls, detections, source, timestamp, trace=None):
+        """Build records for one frame's DETECTION_DTYPE array; each gets its own copy of trace"""
+        return [
+            cls(source, class_id, conf, timestamp, x, y, w, h, dict(trace) if trace else None)
+            for class_id, conf, x, y, w, h in detections.tolist()
+        ]
+    
+    @property
+    def name(self):
+        return CLASS_NAMES[self.class_id]
+    
+    @property
+    def confidence(self):
+        """Confidence in percent, as sent to clients"""
+        # Rounded first so float32 scores like 0.7 don't truncate to 69
+        return int(round(self.score * 100, 3))
+    
+    @property
+    def bbox(self):
+        """Box in percent of the frame, as sent to clients"""
+        return {
+            "left": self.left * 100,
+            "top": self.top * 100,
+            "width": self.width * 100,
+            "height": self.height * 100
+        }
@@ -0,0 +1,92 @@
+import json
+import numpy as np
+
+def parse_regions(text):
+    """Parse CAMERA_REGIONS, e.g. '{"fridge1": {"top": [0, 0, 1, 0.4], "door": [0.7, 0, 0.3, 1]}}'
+    
+    Regions are left/top/width/height fractions of the frame, named per source.
+    Returns source -> list of (name, (left, top, width, height)).
+    """
+    if not text:
+        return {}
+    return {
+        source: [(name, tuple(float(v) for v in rect)) for name, rect in regions.items()]
+        for source, regions in json.loads(text).items()
+    }
+
+def parse_tiles(text):
+    """Parse INFERENCE_TILES, e.g. "2x2" (columns x rows)"""
+    cols, _, rows = (text or "1x1").lower().partition("x")
+    return max(int(cols), 1), max(int(rows or cols), 1)
+
+def region_to_pixels(rect, width, height):
+    """Convert a fractional region to an (x, y, w, h) pixel rect clipped to the frame"""
+    left, top, w, h = rect
+    x = min(max(int(round(left * width)), 0), width - 1)
+    y = min(max(int(round(top * height)), 0), height - 1)
+    return x, y, max(min(int(round(w * width)), width - x), 1), max(min(int(round(h * height)), height - y), 1)
+
+def tile_rects(rect, tiles=(1, 1), overlap=0.2):
+    """Split an (x, y, w, h) pixel rect into a grid of tiles overlapping by a fraction of the tile size"""
+    x, y, w, h = rect
+    cols, rows = tiles
+    tile_w = w / (cols - (cols - 1) * overlap)
+    tile_h = h / (rows - (rows - 1) * overlap)
+    return [
+        (x + int(round(c * tile_w * (1 - overlap))), y + int(round(r * tile_h * (1 - overlap))),
+         min(int(round(tile_w)), w), min(int(round(tile_h)), h))
+        for r in range(rows)
+        for c in range(cols)
+    ]
+
+def rects_to_percent(rects, width, height):
+    """Convert (x, y, w, h) pixel rects to an (N, 4) array in percent of the frame, the tracker's box units"""
+    return np.array(rects, dtype=np.float32).reshape(-1, 4) * np.array(
+        [100 / width, 100 / height, 100 / width, 100 / height], dtype=np.float32
+    )
+
+def to_frame(detections, rect, width, height):
+    """Map a detection array with boxes as fractions of a crop back to fractions of the whole frame"""
+    x, y, w, h = rect
+    detections = detections.copy()
+    detections["x"] = (x + detections["x"] * w) / width
+    detections["y"] = (y + detections["y"] * h) / height
+    detections["w"] *= w / width
+    detections["h"] *= h / height
+    return detections
+
+def merge_detections(detections, threshold=0.6):
+    """Merge duplicate detections from overlapping tiles and regions.
+    
+    Boxes of the same class are greedily merged, best confidence first, when
+    their intersection covers more than threshold of the smaller box. Item
+    halves cut by a tile edge are covered by the whole-item box from the
+    neighbouring tile, so plain IoU would miss them. The kept box grows to the
+    union of the boxes merged into it.
+    """
+    if len(detections) < 2:
+        return detections
+    
+    detections = detections[np.argsort(-detections["conf"], kind="stable")]
+    x1, y1 = detections["x"].astype(np.float64), detections["y"].astype(np.float64)
+    x2, y2 = x1 + detections["w"], y1 + detections["h"]
+    inter_w = np.clip(np.minimum(x2[:, None], x2[None, :]) - np.maximum(x1[:, None], x1[None, :]), 0, None)
+    inter_h = np.clip(np.minimum(y2[:, None], y2[None, :]) - np.maximum(y1[:, None], y1[None, :]), 0, None)
+    areas = (x2 - x1) * (y2 - y1)
+    overlap = inter_w * inter_h / np.maximum(np.minimum(areas[:, None], areas[None, :]), 1e-9)
+    class_ids = detections["class_id"]
+    duplicate = (overlap > threshold) & (class_ids[:, None] == class_ids[None, :])
+    
+    kept = []
+    remaining = np.ones(len(detections), dtype=bool)
+    for i in range(len(detections)):
+        if not remaining[i]:
+            continue
+        group = duplicate[i] & remaining
+        group[i] = True
+        remaining &= ~group
+        left, top = x1[group].min(), y1[group].min()
+        detections["x"][i], detections["y"][i] = left, top
+        detections["w"][i], detections["h"][i] = x2[group].max() - left, y2[group].max() - top
+        kept.append(i)
+    return detections[kept]
@@ -0,0 +1,94 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import cv2
+
+def dhash(gray):
+    """64-bit difference hash of a gray image: is each pixel brighter than its right neighbour, on a 9x8 downscale"""
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(small[:, 1:] > small[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+class ResultCache:
+    """LRU cache from perceptual frame hash to detection arrays, per source.
+    
+    Nearly identical frames hash to codes a few bits apart, so a lookup
+    reuses the detections of any cached frame from the same source within
+    max_distance bits that is younger than ttl seconds. Entries are bounded
+    by max_entries across all sources, least recently used evicted first.
+    """
+    
+    def __init__(self, max_entries=256, ttl=5.0, max_distance=4, width=160, height=90):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        # (source, hash) -> (detections, stored_at, size in bytes), least recently used first
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Downscale buffers for hashing frames when there is no motion gate gray frame to reuse
+        self.small = np.empty((height, width, 3), dtype=np.uint8)
+        self.gray = np.empty((height, width), dtype=np.uint8)
+    
+    def frame_hash(self, frame):
+        """Hash a full BGR frame; only called from the dispatch thread"""
+        cv2.resize(frame, (self.gray.shape[1], self.gray.shape[0]), dst=self.small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self.small, cv2.COLOR_BGR2GRAY, dst=self.gray)
+        return dhash(self.gray)
+    
+    def get(self, source, frame_hash, now=None):
+        """Return cached detections for a close enough frame from source, or None"""
+        now = time.time() if now is None else now
+        with self.lock:
+            best_key = None
+            best_distance = self.max_distance + 1
+            for key, (_, stored_at, _) in self.entries.items():
+                if key[0] != source or now - stored_at > self.ttl:
+                    continue
+                distance = (key[1] ^ frame_hash).bit_count()
+                if distance < best_distance:
+                    best_key, best_distance = key, distance
+                    if distance == 0:
+                        break
+            if best_key is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_key)
+            return self.entries[best_key][0]
+    
+    def put(self, source, frame_hash, detections, now=None):
+        """Cache a frame's detection array, evicting expired and least recently used entries"""
+        now = time.time() if now is None else now
+        size = detections.nbytes
+        with self.lock:
+            key = (source, frame_hash)
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self.entries[key] = (detections, now, size)
+            self.bytes += size
+            while self.entries:
+                oldest_key, (_, stored_at, oldest_size) = next(iter(self.entries.items()))
+                if len(self.entries) <= self.max_entries and now - stored_at <= self.ttl:
+                    break
+                del self.entries[oldest_key]
+                self.bytes -= oldest_size
+    
+    def clear(self):
+        """Drop every cached entry"""
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+    
+    def get_hit_rate(self):
+        """Return the fraction of lookups served from the cache"""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+    
+    def get_memory(self):
+        """Return the approximate bytes held by cached detections"""
+        return self.bytes
@@ -3,76 +3,266 @@ import time
 import queue
 import threading
 import json
+import numpy as np
+from collections import deque
+from pipeline import ChannelClosed
+from records import Frame
+
+def parse_sources(text):
+    """Parse CAMERA_SOURCES, e.g. "fridge1=0,fridge2=rtsp://host/stream,test=/data/fridge.mp4"
+    
+    Entries without an id are named after their position. Integer URIs are
+    local camera indexes.
+    """
+    sources = []
+    for i, entry in enumerate(part.strip() for part in text.split(",")):
+        if not entry:
+            continue
+        source_id, sep, uri = entry.partition("=")
+        if not sep:
+            source_id, uri = f"camera{i}", entry
+        sources.append({"id": source_id.strip(), "uri": int(uri) if uri.strip().isdigit() else uri.strip()})
+    return sources
+
+class SyntheticCapture:
+    """cv2.VideoCapture stand-in generating frames, for benchmarks and tests without hardware.
+    
+    URI format: synthetic://1280x720. The scene is static except for a block
+    that moves for one second out of every door_interval seconds, like an
+    item being put in.
+    """
+    
+    def __init__(self, uri, door_interval=10):
+        size = uri[len("synthetic://"):] or "1280x720"
+        self.width, self.height = (int(v) for v in size.split("x"))
+        self.door_interval = door_interval
+        gradient = np.linspace(40, 200, self.width, dtype=np.uint8)
+        self.background = np.repeat(np.tile(gradient, (self.height, 1))[:, :, None], 3, axis=2)
+        self.start_time = time.time()
+        self.opened = True
+    
+    def isOpened(self):
+        return self.opened
+    
+    def set(self, prop, value):
+        return False
+    
+    def read(self, image=None):
+        if image is None or image.shape != self.background.shape:
+            image = np.empty_like(self.background)
+        image[:] = self.background
+        phase = (time.time() - self.start_time) % self.door_interval
+        if phase < 1.0:
+            x = int(phase * (self.width - self.width // 5))
+            y = self.height // 3
+            cv2.rectangle(image, (x, y), (x + self.width // 5, y + self.height // 4), (30, 90, 220), -1)
+        return True, image
+    
+    def release(self):
+        self.opened = False
+
+def open_capture(uri):
+    """Open a camera index, RTSP/HTTP stream, video file or synthetic:// source"""
+    if isinstance(uri, str) and uri.startswith("synthetic://"):
+        return SyntheticCapture(uri)
+    return cv2.VideoCapture(uri)
+
+class FairFrameQueue:
+    """Frame queue with a bounded sub-queue per source, served round-robin.
+    
+    Each source drops its own oldest frame when its sub-queue is full, so a
+    fast camera cannot push out frames from the others, and get() alternates
+    between sources so none of them is starved.
+    """
+    
+    def __init__(self, per_source_size=8):
+        self.per_source_size = per_source_size
+        self.queues = {}
+        self.order = deque()
+        self.dropped = {}
+        self.condition = threading.Condition()
+        self.closed = False
+    
+    @property
+    def maxsize(self):
+        return self.per_source_size * max(len(self.queues), 1)
+    
+    def qsize(self):
+        with self.condition:
+            return sum(len(q) for q in self.queues.values())
+    
+    def empty(self):
+        return self.qsize() == 0
+    
+    def put(self, frame, block=False):
+        """Add a frame, dropping the oldest frame of the same source if full"""
+        source = frame.source
+        with self.condition:
+            q = self.queues.get(source)
+            if q is None:
+                q = self.queues[source] = deque()
+                self.order.append(source)
+                self.dropped[source] = 0
+            if len(q) >= self.per_source_size:
+                q.popleft()
+                self.dropped[source] += 1
+            q.append(frame)
+            self.condition.notify()
+    
+    def get(self, block=True, timeout=None):
+        """Return the next frame, taking sources in turn"""
+        with self.condition:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                for _ in range(len(self.order)):
+                    source = self.order[0]
+                    self.order.rotate(-1)
+                    if self.queues[source]:
+                        return self.queues[source].popleft()
+                if self.closed:
+                    raise ChannelClosed
+                if not block:
+                    raise queue.Empty
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self.condition.wait(remaining)
+    
+    def close(self):
+        """Wake every waiting consumer; get() raises ChannelClosed once drained"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
 
 class StreamReceiver:
-    def __init__(self, frame_queue, event_queue):
+    def __init__(self, frame_queue, event_queue, frame_rings, sources=None, fps=15, controller=None):
         self.frame_queue = frame_queue
         self.event_queue = event_queue
-        self.camera = None
-        self.frame_count = 0
-        self.start_time = time.time()
-        self.fps = 0
+        # Frames are captured in place into each source's shared memory slots
+        self.frame_rings = frame_rings
+        self.sources = sources or [{"id": "default", "uri": 0}]
+        self.target_fps = fps
+        # Optional CaptureController - only every stride-th frame is published
+        self.controller = controller
+        # Per-source FPS accounting
+        self.source_fps = {source["id"]: 0 for source in self.sources}
+        # Set by reset() to close and reopen every source
+        self.resetting = threading.Event()
     
     def run(self, stop_flag):
-        """Run the stream receiver in a loop"""
-        self.event_queue.put({"type": "log", "message": "カメラ接続中..."})
+        """Run one capture thread per source until stopped, restarting them after a reset"""
+        while True:
+            self.resetting.clear()
+            threads = []
+            for source in self.sources:
+                thread = threading.Thread(target=self.capture, args=(source, stop_flag))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            
+            for thread in threads:
+                thread.join()
+            if not stop_flag.is_set() and not self.resetting.is_set():
+                # Every source failed or ended; stay alive so a reset can reopen them
+                self.event_queue.put({"type": "log", "message": "全カメラ停止 - リセット待機中"})
+                while not stop_flag.is_set() and not self.resetting.wait(1):
+                    pass
+            if stop_flag.is_set():
+                break
+    
+    def reset(self):
+        """Release and reopen every source on the same thread pool and frame rings"""
+        self.resetting.set()
+    
+    def capture(self, source, stop_flag):
+        """Capture frames from a single source in a loop"""
+        source_id = source["id"]
+        frame_ring = self.frame_rings[source_id]
+        fps = source.get("fps", self.target_fps)
+        is_file = isinstance(source["uri"], str) and "://" not in source["uri"]
+        # Files and generated frames are available instantly, so they are paced to fps
+        paced = is_file or isinstance(source["uri"], str) and source["uri"].startswith("synthetic://")
+        camera = None
+        frame_count = 0
+        start_time = time.time()
+        self.event_queue.put({"type": "log", "message": f"カメラ接続中... ({source_id})"})
         
         try:
-            # Try to open the camera
-            self.camera = cv2.VideoCapture(0)  # Use default camera
-            if not self.camera.isOpened():
-                self.event_queue.put({"type": "log", "message": "エラー: カメラが見つかりません"})
+            # Try to open the camera, stream or file
+            camera = open_capture(source["uri"])
+            if not camera.isOpened():
+                self.event_queue.put({"type": "log", "message": f"エラー: カメラが見つかりません ({source_id})"})
                 return
             
             # Set camera properties
-            self.camera.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-            self.camera.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-            self.camera.set(cv2.CAP_PROP_FPS, 15)
+            camera.set(cv2.CAP_PROP_FRAME_WIDTH, frame_ring.width)
+            camera.set(cv2.CAP_PROP_FRAME_HEIGHT, frame_ring.height)
+            camera.set(cv2.CAP_PROP_FPS, fps)
             
-            self.event_queue.put({"type": "log", "message": "カメラ接続完了"})
+            self.event_queue.put({"type": "log", "message": f"カメラ接続完了 ({source_id})"})
+            self.event_queue.put({"type": "ready", "component": "stream_receiver", "source": source_id})
             
             # Main loop to read frames
-            while not stop_flag.is_set():
-                ret, frame = self.camera.read()
+            next_frame_time = time.time()
+            captured = 0
+            while not stop_flag.is_set() and not self.resetting.is_set():
+                stride = self.controller.stride if self.controller is not None else 1
+                captured += 1
+                if not paced and captured % stride:
+                    # Live sources keep running at their own rate - drain the frame without decoding it
+                    if not camera.grab():
+                        self.event_queue.put({"type": "log", "message": f"警告: フレーム取得失敗 ({source_id})"})
+                        stop_flag.wait(0.1)
+                    continue
+                
+                # Read straight into the next ring slot
+                slot = frame_ring.acquire()
+                ret, frame = camera.read(image=slot)
                 
                 if not ret:
-                    self.event_queue.put({"type": "log", "message": "警告: フレーム取得失敗"})
-                    time.sleep(0.1)
+                    if is_file:
+                        # Loop video files so they can stand in for a camera
+                        camera.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                        continue
+                    self.event_queue.put({"type": "log", "message": f"警告: フレーム取得失敗 ({source_id})"})
+                    stop_flag.wait(0.1)
                     continue
                 
+                if frame is not slot:
+                    # Source ignored the requested size - scale into the slot
+                    cv2.resize(frame, (frame_ring.width, frame_ring.height), dst=slot)
+                
                 # Update FPS calculation
-                self.frame_count += 1
-                elapsed_time = time.time() - self.start_time
+                frame_count += 1
+                elapsed_time = time.time() - start_time
                 if elapsed_time >= 1.0:  # Update FPS every second
-                    self.fps = self.frame_count / elapsed_time
-                    self.frame_count = 0
-                    self.start_time = time.time()
+                    self.source_fps[source_id] = frame_count / elapsed_time
+                    frame_count = 0
+                    start_time = time.time()
                 
-                # Try to add frame to queue, skip if queue is full
-                try:
-                    # Convert to RGB for model input
-                    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                    frame_data = {
-                        "frame": rgb_frame,
-                        "timestamp": time.time()
-                    }
-                    self.frame_queue.put(frame_data, block=False)
-                except queue.Full:
-                    # Skip frame if queue is full
-                    pass
+                # Publish the slot; consumers convert color themselves as needed
+                timestamp = time.time()
+                slot_index, seq = frame_ring.commit(timestamp)
+                self.frame_queue.put(Frame(source_id, slot_index, seq, timestamp), block=False)
                 
-                # Don't hog the CPU
-                time.sleep(0.01)
+                if paced:
+                    # Read as fast as the disk allows - pace at the source rate, slowed by the stride
+                    next_frame_time = max(next_frame_time + stride / fps, time.time() - 1.0)
+                    stop_flag.wait(max(next_frame_time - time.time(), 0))
         
         except Exception as e:
-            self.event_queue.put({"type": "log", "message": f"カメラエラー: {str(e)}"})
+            self.event_queue.put({"type": "log", "message": f"カメラエラー: {str(e)} ({source_id})"})
         
         finally:
             # Release resources
-            if self.camera is not None and self.camera.isOpened():
-                self.camera.release()
-                self.event_queue.put({"type": "log", "message": "カメラ接続解除"})
+            if camera is not None and camera.isOpened():
+                camera.release()
+                self.event_queue.put({"type": "log", "message": f"カメラ接続解除 ({source_id})"})
     
     def get_fps(self):
-        """Return the current FPS rate"""
-        return self.fps
+        """Return the combined FPS rate of all sources"""
+        return sum(self.source_fps.values())
+    
+    def get_source_fps(self):
+        """Return the FPS rate per source"""
+        return dict(self.source_fps)
@@ -0,0 +1,174 @@
+import itertools
+import numpy as np
+
+def boxes_from_detections(detections):
+    """Stack detection boxes into an (N, 4) left/top/width/height array in percentage units"""
+    if not detections:
+        return np.empty((0, 4), dtype=np.float32)
+    return np.array(
+        [(d.left, d.top, d.width, d.height) for d in detections], dtype=np.float32
+    ) * 100
+
+def iou_matrix(a, b):
+    """Pairwise IoU between (N, 4) and (M, 4) left/top/width/height boxes"""
+    a_x2 = a[:, 0] + a[:, 2]
+    a_y2 = a[:, 1] + a[:, 3]
+    b_x2 = b[:, 0] + b[:, 2]
+    b_y2 = b[:, 1] + b[:, 3]
+    inter_w = np.clip(np.minimum(a_x2[:, None], b_x2[None, :]) - np.maximum(a[:, 0, None], b[None, :, 0]), 0, None)
+    inter_h = np.clip(np.minimum(a_y2[:, None], b_y2[None, :]) - np.maximum(a[:, 1, None], b[None, :, 1]), 0, None)
+    inter = inter_w * inter_h
+    union = (a[:, 2] * a[:, 3])[:, None] + (b[:, 2] * b[:, 3])[None, :] - inter
+    return inter / np.maximum(union, 1e-6)
+
+def centroid_distance_matrix(a, b):
+    """Pairwise distance between box centers, in percentage units"""
+    a_c = a[:, :2] + a[:, 2:] / 2
+    b_c = b[:, :2] + b[:, 2:] / 2
+    return np.linalg.norm(a_c[:, None, :] - b_c[None, :, :], axis=2)
+
+class ObjectTracker:
+    """Turns per-frame detections into stable per-source item tracks.
+    
+    Detections are matched to existing tracks of the same class by IoU (with a
+    centroid-distance fallback for small, jittery boxes) using greedy
+    assignment. A detection is only passed on when its track is first
+    confirmed, when it moves noticeably, or every refresh_interval seconds so
+    last_seen keeps advancing.
+    """
+    
+    def __init__(self, iou_threshold=0.3, centroid_threshold=5.0, min_hits=3, max_misses=15,
+                 move_iou=0.5, refresh_interval=30):
+        self.iou_threshold = iou_threshold
+        self.centroid_threshold = centroid_threshold
+        self.min_hits = min_hits
+        self.max_misses = max_misses
+        self.move_iou = move_iou
+        self.refresh_interval = refresh_interval
+        self.tracks = {}  # source -> list of tracks
+        self.next_id = itertools.count(1)
+        self.received = 0
+        self.emitted = 0
+    
+    def match(self, tracks, detections, boxes):
+        """Greedily pair tracks with detections, best score first"""
+        if not tracks or not detections:
+            return []
+        
+        track_boxes = np.stack([track["box"] for track in tracks])
+        scores = iou_matrix(track_boxes, boxes)
+        # Close centers count as a weak match even without overlap
+        near = centroid_distance_matrix(track_boxes, boxes) <= self.centroid_threshold
+        scores = np.where((scores < self.iou_threshold) & near, self.iou_threshold, scores)
+        # Only match within the same class
+        track_classes = np.array([track["class_id"] for track in tracks])
+        detection_classes = np.array([detection.class_id for detection in detections])
+        scores[track_classes[:, None] != detection_classes[None, :]] = 0
+        
+        pairs = []
+        candidates = np.argwhere(scores >= self.iou_threshold)
+        order = np.argsort(-scores[candidates[:, 0], candidates[:, 1]], kind="stable")
+        used_tracks = set()
+        used_detections = set()
+        for t, d in candidates[order]:
+            if t in used_tracks or d in used_detections:
+                continue
+            used_tracks.add(t)
+            used_detections.add(d)
+            pairs.append((t, d))
+        return pairs
+    
+    def update(self, source, timestamp, detections, regions=None):
+        """Feed one processed frame's detections and return those worth emitting.
+        
+        regions, an (N, 4) array in percentage units, limits which unmatched
+        tracks count a miss to those centered inside the parts of the frame
+        that were actually run.
+        """
+        self.received += len(detections)
+        tracks = self.tracks.setdefault(source, [])
+        boxes = boxes_from_detections(detections)
+        pairs = self.match(tracks, detections, boxes)
+        
+        emit = []
+        matched_tracks = set()
+        matched_detections = set()
+        for t, d in pairs:
+            track = tracks[t]
+            matched_tracks.add(t)
+            matched_detections.add(d)
+            track["box"] = boxes[d]
+            track["hits"] += 1
+            track["misses"] = 0
+            if self.should_emit(track, timestamp):
+                emit.append(self.emit(track, detections[d], timestamp))
+        
+        # Unmatched tracks age out; unmatched detections start new tracks
+        survivors = []
+        for t, track in enumerate(tracks):
+            if t not in matched_tracks and (regions is None or self.covered(track["box"], regions)):
+                track["misses"] += 1
+                if track["misses"] > self.max_misses:
+                    continue
+            survivors.append(track)
+        for d, detection in enumerate(detections):
+            if d in matched_detections:
+                continue
+            track = {
+                "track_id": next(self.next_id),
+                "class_id": detection.class_id,
+                "box": boxes[d],
+                "hits": 1,
+                "misses": 0,
+                "emitted_box": None,
+                "emitted_time": 0
+            }
+            survivors.append(track)
+            if self.should_emit(track, timestamp):
+                emit.append(self.emit(track, detection, timestamp))
+        self.tracks[source] = survivors
+        
+        self.emitted += len(emit)
+        return emit
+    
+    def covered(self, box, regions):
+        """True if the box's center lies inside any of the regions"""
+        cx, cy = box[0] + box[2] / 2, box[1] + box[3] / 2
+        return bool(np.any(
+            (regions[:, 0] <= cx) & (cx < regions[:, 0] + regions[:, 2])
+            & (regions[:, 1] <= cy) & (cy < regions[:, 1] + regions[:, 3])
+        ))
+    
+    def should_emit(self, track, timestamp):
+        """Emit on confirmation, noticeable movement, or after refresh_interval"""
+        if track["hits"] < self.min_hits:
+            return False
+        if track["emitted_box"] is None:
+            return True
+        if timestamp - track["emitted_time"] >= self.refresh_interval:
+            return True
+        moved = iou_matrix(track["box"][None, :], track["emitted_box"][None, :])[0, 0]
+        return moved < self.move_iou
+    
+    def emit(self, track, detection, timestamp):
+        """Record an emission and tag the detection with its track"""
+        track["emitted_box"] = track["box"]
+        track["emitted_time"] = timestamp
+        detection.track_id = track["track_id"]
+        return detection
+    
+    def reset(self):
+        """Drop every track; items are confirmed afresh"""
+        self.tracks = {}
+    
+    def get_active_count(self):
+        """Return the number of confirmed tracks currently alive"""
+        return sum(
+            1 for tracks in self.tracks.values() for track in tracks if track["hits"] >= self.min_hits
+        )
+    
+    def get_reduction(self):
+        """Return the fraction of detections suppressed by tracking"""
+        if not self.received:
+            return 0.0
+        return 1 - self.emitted / self.received
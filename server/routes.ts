@@ -4,6 +4,7 @@ import { WebSocketServer, WebSocket } from "ws";
 import { storage } from "./storage";
 import { spawn } from "child_process";
 import path from "path";
+import readline from "readline";
 import { fileURLToPath } from "url";
 import { FridgeItem } from "@shared/schema";
 
@@ -14,6 +15,38 @@ const __dirname = path.dirname(__filename);
 // Store active WebSocket connections
 const clients = new Set<WebSocket>();
 
+// The Python APIServer keeps a versioned, in-memory inventory index
+const pythonApiUrl = `http://127.0.0.1:${process.env.API_PORT || 8765}`;
+
+interface Inventory {
+  full: boolean;
+  epoch: number | null;
+  version: number;
+  items: FridgeItem[];
+}
+
+/**
+ * Fetch the items changed since a version from the Python index.
+ * Without a version, or when the index is unreachable, every item is returned.
+ */
+async function fetchInventory(since?: unknown, epoch?: unknown): Promise<Inventory> {
+  try {
+    // A blank since still asks for the envelope, which is then a full snapshot
+    const params = new URLSearchParams({ since: since != null ? String(since) : '' });
+    if (epoch != null) {
+      params.set('epoch', String(epoch));
+    }
+    const response = await fetch(`${pythonApiUrl}/items?${params}`);
+    if (response.ok) {
+      return await response.json();
+    }
+  } catch (error) {
+    // Python process is starting or restarting - fall through to the database
+  }
+  const items = await storage.getAllItems();
+  return { full: true, epoch: null, version: 0, items: items as FridgeItem[] };
+}
+
 export async function registerRoutes(app: Express): Promise<Server> {
   const httpServer = createServer(app);
   
@@ -47,9 +80,14 @@ export async function registerRoutes(app: Express): Promise<Server> {
         const data = JSON.parse(message.toString());
         
         if (data.action === 'reset_system') {
-          // Restart Python processes
-          pyProcess?.kill();
-          startPythonProcess();
+          // Soft reset restarts the stages in place, keeping imports and loaded models;
+          // fall back to restarting the Python process if it is not running or a hard reset was asked for
+          if (!data.hard && pyProcess?.stdin?.writable && pyProcess.exitCode === null) {
+            pyProcess.stdin.write(JSON.stringify({ action: 'soft_reset' }) + '\n');
+          } else {
+            pyProcess?.kill();
+            startPythonProcess();
+          }
           
           // Notify clients
           broadcastMessage({
@@ -60,11 +98,12 @@ export async function registerRoutes(app: Express): Promise<Server> {
         
         if (data.action === 'refresh_inventory') {
           try {
-            const items = await storage.getAllItems();
-            broadcastMessage({
+            // Only the requesting client needs the result, and only what changed since its version
+            const inventory = await fetchInventory(data.since, data.epoch);
+            ws.send(JSON.stringify({
               type: 'refresh_complete',
-              items
-            });
+              ...inventory
+            }));
           } catch (error) {
             console.error('Error refreshing inventory:', error);
           }
@@ -84,8 +123,13 @@ export async function registerRoutes(app: Express): Promise<Server> {
   // REST API routes
   app.get('/api/items', async (req, res) => {
     try {
-      const items = await storage.getAllItems();
-      res.json(items);
+      // ?since=<version>&epoch=<epoch> returns a delta envelope; otherwise the full list
+      if (req.query.since !== undefined) {
+        res.json(await fetchInventory(req.query.since, req.query.epoch));
+        return;
+      }
+      const inventory = await fetchInventory();
+      res.json(inventory.items);
     } catch (error) {
       console.error('Error fetching items:', error);
       res.status(500).json({ error: 'Failed to fetch items' });
@@ -106,19 +150,28 @@ export async function registerRoutes(app: Express): Promise<Server> {
     
     // TypeScript null check for stdout
     if (pyProcess && pyProcess.stdout) {
-      pyProcess.stdout.on('data', (data) => {
+      // Events arrive as newline-delimited JSON; readline reassembles lines
+      // that are split across or coalesced within stdout chunks
+      const lines = readline.createInterface({ input: pyProcess.stdout, crlfDelay: Infinity });
+      lines.on('line', (line) => {
         try {
-          const message = data.toString().trim();
-          console.log(`Python stdout: ${message}`);
+          const message = line.trim();
+          if (!message) {
+            return;
+          }
           
           // Try to parse JSON messages
           try {
             const jsonData = JSON.parse(message);
             if (jsonData.type) {
+              if (jsonData.type !== 'system_stats') {
+                console.log(`Python stdout: ${message}`);
+              }
               broadcastMessage(jsonData);
             }
           } catch (e) {
             // Not JSON, just a log message
+            console.log(`Python stdout: ${message}`);
             broadcastMessage({
               type: 'log',
               message: message
@@ -1,14 +1,17 @@
-import { pgTable, text, serial, timestamp } from "drizzle-orm/pg-core";
+import { pgTable, text, serial, timestamp, unique } from "drizzle-orm/pg-core";
 import { createInsertSchema, createSelectSchema } from "drizzle-zod";
 import { z } from "zod";
 
-// FridgeItem table
+// FridgeItem table - items are tracked per camera source (fridge)
 export const fridgeItems = pgTable("fridge_items", {
   item_id: serial("item_id").primaryKey(),
+  source: text("source").notNull().default("default"),
   name: text("name").notNull(),
   first_seen: timestamp("first_seen").notNull(),
   last_seen: timestamp("last_seen").notNull()
-});
+}, (table) => [
+  unique("fridge_items_source_name_unique").on(table.source, table.name)
+]);
 
 // Insertion schema
 export const fridgeItemInsertSchema = createInsertSchema(fridgeItems);